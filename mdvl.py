@@ -25,15 +25,21 @@
 
     export mdvl_debug=1
 
+## Profiling
+
+    export mdvl_profile=1 # or mem: phase timings, counters as JSON on stderr
+
 See also https://github.com/axiros/mdvl
 
 '''
+from __future__ import print_function
 __version__ = "2017.07.16.7" # count up for new pip versions
 __author__ = "Gunther Klessinger"
 
-from textwrap import fill
+# startup time matters (mdvl runs in every help of our tools): re, textwrap,
+# hashlib and collections are imported on first use:
 from operator import setitem as set
-import re, os
+import os, itertools
 
 debug=os.environ.get('mdvl_debug')
 
@@ -79,16 +85,21 @@ class Colors(Cfg):
     O = '\x1B[0m'
     GRAY = 240
     CODE = 245
-    L    = env('L', 66)
-    H1   = env('I', 158)
-    H2   = env('G', 115)
-    H3   = env('M', 72)
-    H4   = env('CODE', 66)
-    emph = env('I', 158)
-    ital = env('M', 72)
+    L    = 66
+    H1   = 158
+    H2   = 115
+    H3   = 72
+    H4   = 66
+    emph = 158
+    ital = 72
+    # defaults from these env keys, read at setup, not at import:
+    _env_dflt = {'H1': 'I', 'H2': 'G', 'H3': 'M', 'H4': 'CODE', 'emph': 'I',
+                 'ital': 'M'}
 
     def get_val(self, k, dflt, kw):
         # see Cfg for expl.
+        if k in self._env_dflt:
+            dflt = env(self._env_dflt[k], dflt)
         v = kw.get(k, env(k, dflt))
         v = str(v)
         if '\x1B' in v:
@@ -124,16 +135,39 @@ class Facts(Cfg):
     header_underlining = '*' # e.g. '*-' to underline H1 with *** and H2 with ---
     opts_tbl_start   = '-'
     opts_tbl_end     = ':'
-
-
-    def __init__(f, md, **kw):
+    cache_size       = 0 # in memory LRU of renderings (entries), 0: off
+    disk_cache_bytes = 20000000 # cli render cache for files, 0: off
+    max_lines        = 0 # stop rendering after that many lines, 0: all
+    # at errors: 'raise', 'none': None (no output), 'print': the clear text
+    # and the error (the cli does that):
+    on_error         = 'raise'
+    profile          = '' # phase timings into .stats, 'mem': + tracemalloc
+    engine           = 'fast' # 'legacy': the original renderer, reference
+    # not from the generic environ key of the same name, but from:
+    _env_keys        = {'engine': 'mdvl_engine', 'profile': 'mdvl_profile'}
+
+    def __init__(f, md, defaults=None, **kw):
         # first check if the config contains color codes and set to C:
         # now overriding our defaults with kw then with env
+        # (defaults: per instance, env and kw still override them)
         if md.split('\n', 1)[0] == md:
             f.single_line_mode = True
             f.indent = 0
+        [setattr(f, k, v) for k, v in (defaults or {}).items()]
         f.setup(kw)
         f.colr = Colors(); f.colr.setup(kw)
+        f.profile = '' if f.profile in ('0', 'False') else f.profile
+        f.prof = f.stats = None # Profile while rendering, its result after
+        if f.engine not in engines:
+            raise Exception('engine must be one of %s, not %s' % (
+                            engines, f.engine))
+
+    def get_val(f, k, dflt, kw):
+        if k in f._env_keys:
+            return type(dflt)(kw.get(k, os.environ.get(f._env_keys[k], dflt)))
+        return Cfg.get_val(f, k, dflt, kw)
+
+engines = ('fast', 'legacy')
 
 # ------------------------------------------------ end config - begin rendering
 # helper funcs:
@@ -156,10 +190,887 @@ def block_quote_status(l, g):
     return lev, _[1], _[0]
 
 
+def extract_fences(lines, code_ref):
+    '''
+    Line scanner for fenced code (``` or ~~~, with optional info string),
+    linear in the number of lines, no regex backtracking.
+    Closing fence: same char, at least as long, nothing else on the line.
+    An unclosed fence runs until the end of the document (as in CommonMark).
+    Blocks are handed to code_ref as "```<info>\\n<code lines>\\n```" and
+    replaced by what it returns. Generator, yielding the lines.
+    '''
+    fence, block = None, None
+    for l in lines:
+        if fence:
+            if fence_end(l, fence):
+                yield code_ref('\n'.join(block + ['```']))
+                fence = None
+            else:
+                block.append(l)
+            continue
+        fence = fence_start(l)
+        if fence:
+            block = ['```' + l[len(fence):].strip()]
+            continue
+        yield l
+    if fence:
+        yield code_ref('\n'.join(block + ['```']))
+
+def fence_start(l):
+    'the fence (e.g. "````") if l opens a fenced code block'
+    if l[:3] in ('```', '~~~'):
+        info = l.lstrip(l[0])
+        # backticks in a backtick fence's info: inline code, not a fence:
+        if not (l[0] == '`' and '`' in info):
+            return l[:len(l) - len(info)]
+
+fence_end = lambda l, fence: (l.startswith(fence) and
+                              not l.lstrip(fence[0]).strip())
+
+
+def segments(lines):
+    '''
+    The top level line groups of a (stripped) document, separated by empty
+    lines (but not within fences). Yields (lines, number of lines after fence
+    extraction, max blockquote depth, header lines), None for the separating
+    empty lines.
+    '''
+    seg, n, bq, hs, fence = [], 0, 0, [], None
+    for l in lines:
+        if fence:
+            if fence_end(l, fence):
+                fence = None
+            seg.append(l)
+            continue
+        if (not l or l.isspace()) and not l.startswith('    '): # no code
+            if seg:
+                yield seg, n, bq, hs
+                seg, n, bq, hs = [], 0, 0, []
+            yield None
+            continue
+        if l[:3] in ('```', '~~~'):
+            fence = fence_start(l)
+        seg.append(l)
+        n += 1
+        if l.startswith('>'):
+            bq = max(bq, len(l.split(' ', 1)[0]))
+        elif l.startswith('#'): # as is_header, in _parse
+            hs.append(l)
+    if seg:
+        yield seg, n, bq, hs
+
+
+def strip_lines(lines):
+    '''
+    str.strip of the document, for an iterable of lines: drops leading and
+    trailing empty lines, lstrips the first and rstrips the last line.
+    '''
+    last, empties = None, []
+    for l in lines:
+        if not l.strip():
+            if last is not None:
+                empties.append(l)
+            continue
+        if last is None:
+            last = l.lstrip()
+            continue
+        yield last
+        for e in empties:
+            yield e
+        last, empties = l, []
+    if last is not None:
+        yield last.rstrip()
+
+_rx = {}
+def rx(p):
+    'compiled regex, re is imported when first needed'
+    if not p in _rx:
+        import re
+        _rx[p] = re.compile(p)
+    return _rx[p]
+
+inline_re = r'(```|`|\*\*|\*)'
+def inline_markup(s, C, tags=None):
+    '''
+    INLINE MARKUP of one text block, in one pass: `code`, **emph**, *ital*.
+    Within code all is literal. Unclosed markers stay literal, stray fence
+    markers (```) are removed. Closing resets the color.
+    tags: open and close str by marker, instead of the colors, e.g. html.
+    '''
+    if not ('*' in s or '`' in s):
+        return s
+    parts = rx(inline_re).split(s)
+    for i, o in inline_pairs(parts[1::2]).items():
+        i, m = 2 * i + 1, parts[2 * i + 1]
+        if o is None:
+            parts[i] = ''
+        elif tags:
+            parts[i] = tags[m][1 - o]
+        else:
+            parts[i] = getattr(C, inline_colr[m]) if o else C.O
+    return ''.join(parts)
+
+def inline_pairs(markers):
+    '''
+    Which of the inline_re markers of a text block are markup, by index:
+    True: opening, False: closing, None: removed. The others are literal.
+    '''
+    res, opn = {}, {} # open markers -> their index
+    for i, m in enumerate(markers):
+        if m == '```':
+            res[i] = None
+        elif '`' in opn and m != '`':
+            continue # literal in code
+        elif m in opn:
+            res[opn.pop(m)], res[i] = True, False
+        else:
+            opn[m] = i
+    return res
+
+# WRAPPING: as textwrap.fill, but by visible width: inline markup, ANSI
+# escapes and code placeholders are zero width, East Asian wide chars two:
+_cw = {}
+def char_width(c):
+    'terminal columns of c, cached'
+    w = _cw.get(c)
+    if w is None:
+        import unicodedata
+        if unicodedata.category(c) in ('Mn', 'Me', 'Cf'): # combining, zwj
+            w = 0
+        else:
+            w = 2 if unicodedata.east_asian_width(c) in ('W', 'F') else 1
+        _cw[c] = w
+    return w
+
+def narrow(s):
+    'all chars of s one column'
+    if not s or hasattr(s, 'isascii') and s.isascii():
+        return True
+    return max(s) < u'\u0300'
+
+# textwrap's chunks (whitespace being spaces): spaces, em-dashes, words
+# (hyphenated ones split after the hyphens):
+wordsep_re = (r'( +|(?<=%(wp)s)-{2,}(?=\w)|[^ ]+?(?:-(?:(?<=%(lt)s{2}-)|'
+              r'(?<=%(lt)s-%(lt)s-))(?=%(lt)s-?%(lt)s)|(?= |\Z)|'
+              r'(?<=%(wp)s)(?=-{2,}\w)))') % {
+                      'wp': r'[\w!"\'&.,?]', 'lt': r'[^\d\W]'}
+
+def starts(lens):
+    'start offsets of consecutive pieces with lengths lens'
+    if hasattr(itertools, 'accumulate'):
+        return [0] + list(itertools.accumulate(lens[:-1]))
+    res = [0]
+    for n in lens[:-1]:
+        res.append(res[-1] + n)
+    return res
+
+def zero_width(s):
+    'sorted (start, end) ranges of s not shown: inline markup, escapes, code'
+    res = []
+    if '*' in s or '`' in s:
+        parts = rx(inline_re).split(s)
+        at = starts(list(map(len, parts)))
+        res = [(at[2 * i + 1], at[2 * i + 2])
+               for i in inline_pairs(parts[1::2])]
+    for c, p in ('\x1b', sgr_re), ('\x02', code_ph_re):
+        if c in s:
+            res.extend([m.span() for m in rx(p).finditer(s)])
+    return sorted(res)
+
+def wrap(s, width, indent=''):
+    '''
+    textwrap.fill(s, width, subsequent_indent=indent) - breaking on spaces
+    and hyphens, long words are broken - for the visible width of s.
+    '''
+    if '\t' in s:
+        s = s.expandtabs()
+    for c in '\n\x0b\x0c\r':
+        if c in s:
+            s = s.replace(c, ' ')
+    # chunks: words and spaces, with their widths:
+    cs = rx('( +)').split(s) # empty only at start and end
+    cs = cs[(not cs[0]):len(cs) - (not cs[-1])]
+    if '-' in s: # textwrap's lookbehinds do not cross spaces, so per word:
+        hy, b, res = [k for k, c in enumerate(cs) if '-' in c], 0, []
+        sep = rx(wordsep_re)
+        for k in hy:
+            res.extend(cs[b:k])
+            res.extend([p for p in sep.split(cs[k]) if p])
+            b = k + 1
+        cs = res + cs[b:]
+    wl = list(map(len, cs))
+    zero, nrw = zero_width(s), narrow(s)
+    if zero or not nrw:
+        from bisect import bisect
+        at = starts(wl) # chunk positions in s
+        if not nrw:
+            wl = [sum([char_width(c) for c in w]) for w in cs]
+        # zero width chars are ascii (i.e. were 1) and w/o spaces or hyphens,
+        # i.e. within one chunk:
+        for i, j in zero:
+            wl[bisect(at, i) - 1] -= j - i
+
+    def char_widths(k):
+        'widths of the chars of chunk k'
+        c = cs[k]
+        if nrw and not zero:
+            return [1] * len(c)
+        r = [char_width(x) for x in c]
+        for i, j in zero:
+            if i < at[k] + len(c) and j > at[k]:
+                i, j = max(i - at[k], 0), j - at[k]
+                r[i:j] = [0] * len(r[i:j])
+        return r
+
+    lines, k, m = [], 0, len(cs)
+    while k < m:
+        avail = width - (len(indent) if lines else 0)
+        if lines and (not cs[k] or cs[k][0] == ' '): # no line start space
+            k += 1
+            continue
+        b, n = k, 0
+        while k < m and n + wl[k] <= avail:
+            n += wl[k]
+            k += 1
+        cur = cs[b:k]
+        if k < m and wl[k] > avail: # too long for any line, split it:
+            c, left, e, w = cs[k], avail - n if avail > 0 else 1, 0, 0
+            cw = char_widths(k)
+            while e < len(c):
+                w += cw[e]
+                if w > left:
+                    break
+                e += 1
+            h = c.rfind('-', 0, e)
+            if e < len(c) and h > 0 and c[:h].strip('-'):
+                e = h + 1
+            if e == 0 and not cur:
+                e = 1 # wide char, wider than the line
+            if e:
+                cur.append(c[:e])
+                cs[k], wl[k] = c[e:], sum(cw[e:])
+                if zero or not nrw:
+                    at[k] += e
+        if cur and (not cur[-1] or cur[-1][0] == ' '):
+            cur.pop()
+        if cur:
+            lines.append(''.join(cur))
+    return ('\n' + indent).join(lines)
+
 h_rules_col = {'-': 'L', '_': 'H3', '*': 'H1'} # different colors
 list_markup = {'- ': ('\x03 ', 'L', '❖ '), '* ': ('\x04 ', 'H2', '▪ ')}
 h_rules     = '---', '___', '***'
+inline_colr = {'`': 'CODE', '**': 'emph', '*': 'ital'}
+
+# line classification flags, see classify:
+T_EMPTY, T_HEADER, T_LIST, T_OPTS, T_LINK, T_CODE, T_RULE, T_INDENT = (
+        1, 2, 4, 8, 16, 32, 64, 128)
+T_NEW = T_EMPTY | T_HEADER | T_LIST | T_OPTS | T_LINK | T_CODE | T_RULE
+# block tree, from _parse, tuples with the kind first:
+# (B_EMPTY,), (B_RULE, color name, is header underline), (B_CODE, code),
+# (B_TEXT, line, subseq indent, header level, blockquote mark, max bq depth,
+#  fenced code blocks by placeholder nr)
+B_EMPTY, B_RULE, B_CODE, B_TEXT = 0, 1, 2, 3
+# code block placeholders, pointing into the code list of _parse:
+code_ph, code_ph_re = '\x02%s\x02', '\x02(\\d+)\x02'
+
+# Line Tools:
+first_word = lambda l: l.split(' ', 1)[0]
+is_header  = lambda l: l.startswith('#')
+is_list    = lambda l: l.lstrip()[:2] in list_markup
+is_empty   = lambda l: l.strip() == ''
+is_md_link = lambda l: l[0] == '[' and 'http' in l and ']' in l
+
+def is_opts_tbl(l, b, e):
+    'b, e: opts_tbl_start and _end of the facts'
+    fw = first_word(l)
+    if fw and fw.startswith(b) and fw.endswith(e):
+        return l.replace(fw, '*%s*' % fw[:-len(e)]), len(fw)
+    return l, None
+
+def is_rule(l):
+    if not l[:3] in h_rules:
+        return
+    ll = len(l)
+    return True if l in (ll * '-', ll * '*', ll * '_') else False
+
+def classify(l, b, e):
+    'the T_ flags of a line'
+    t = T_INDENT if l.startswith('    ') else 0
+    if is_empty(l):
+        return t | T_EMPTY
+    if is_header(l)            : t |= T_HEADER
+    if is_list(l)              : t |= T_LIST
+    if is_opts_tbl(l, b, e)[1] : t |= T_OPTS
+    if is_md_link(l)           : t |= T_LINK
+    if l[0] == '\x02'          : t |= T_CODE
+    if is_rule(l)              : t |= T_RULE
+    return t
+
+def join_parts(parts):
+    'the lines of a textblock, joined by one space'
+    if len(parts) == 1:
+        return parts[0]
+    return ' '.join([parts[0].rstrip()] + [p.strip() for p in parts[1:-1]] +
+                    [parts[-1].lstrip()])
+
+# RENDER CACHE: keyed by the content and the resolved config, so that e.g. a
+# different width or color can't hit an old rendering:
+lru = None # OrderedDict, when first used
+cache_nokey = ('debug', 'no_print', 'cache_size', 'disk_cache_bytes',
+               'profile', 'on_error')
+to_bytes = lambda s: s if isinstance(s, bytes) else s.encode('utf-8')
+# builtin, cheap. Threads rendering share lru:
+from _thread import allocate_lock, get_ident
+lru_lock = allocate_lock()
+
+def cache_key(md, f):
+    'sha1 of md and the _parms values of facts and colors'
+    p = [(k, getattr(o, k)) for o in (f, f.colr) for k, d in o._parms
+         if k not in cache_nokey]
+    import hashlib
+    h = hashlib.sha1(to_bytes(repr((__version__, p))))
+    h.update(to_bytes(md))
+    return h.hexdigest()
+
 def _main(md, f):
+    global lru
+    if f.profile: # f is not shared then (see Renderer.render)
+        f.stats = None
+    if f.cache_size > 0:
+        k = cache_key(md, f)
+        with lru_lock:
+            if lru is None:
+                from collections import OrderedDict
+                lru = OrderedDict()
+            out = lru.pop(k, None)
+        if out is None:
+            out = ''.join(_render(src_lines(md, f), f))
+        elif f.profile:
+            f.stats = {'cached': True}
+        with lru_lock:
+            lru[k] = out # most recent last
+            while len(lru) > f.cache_size:
+                lru.popitem(last=False)
+    else:
+        out = ''.join(_render(src_lines(md, f), f))
+    if not f.no_print:
+        if f.stats and 'phases' in f.stats:
+            p = Profile()
+            p.timed('print', print)(out)
+            f.stats['phases'].update(p.result()['phases'])
+        else:
+            print (out)
+    dump_stats(f)
+    return out
+
+def _render(src, f):
+    '''
+    The renderer, a generator of output chunks for an iterable of source
+    lines. Chunks are yielded when the next block is complete, memory is
+    bounded by the largest block (and the first header_numbering lines,
+    buffered to decide about auto numbering).
+    '''
+    if f.engine == 'legacy':
+        chunks = legacy(src, f)
+    elif f.profile:
+        return profiled(src, f)
+    else:
+        chunks = _layout(_parse(strip_lines(src), f), f)
+    return cut_lines(chunks, f) if f.max_lines > 0 else chunks
+
+class Profile(object):
+    '''
+    Phase timings of a rendering (profile=True or $mdvl_profile): wall time
+    and calls (generators: items) per phase, exclusive of the phases called
+    within, with profile='mem' also the tracemalloc peak above the start.
+    '''
+    def __init__(self, mem=False):
+        import time
+        self.clock = getattr(time, 'perf_counter', time.time)
+        self.phases, self.stack, self.mem = {}, [], None
+        self.counts = dict.fromkeys((
+            'lines', 'text', 'indented_code', 'fenced_code', 'rules', 'empty',
+            'headers', 'max_bq_depth', 'wrapped', 'out_lines', 'out_chars'),
+            0)
+        if mem:
+            import tracemalloc as tm
+            self.mem, self.started = tm, not tm.is_tracing()
+            self.started and tm.start()
+            self.base = tm.get_traced_memory()[0]
+        self.t0 = self.t = self.clock()
+
+    def switch(self):
+        'charges the time (and memory peak) since the last switch'
+        now = self.clock()
+        if self.stack:
+            ph = self.phases[self.stack[-1]]
+            ph['time'] += now - self.t
+            if self.mem:
+                peak = self.mem.get_traced_memory()[1] - self.base
+                ph['peak_kb'] = max(ph.get('peak_kb', 0), peak // 1024)
+                hasattr(self.mem, 'reset_peak') and self.mem.reset_peak()
+        self.t = now
+
+    def enter(self, name):
+        self.switch()
+        self.stack.append(name)
+        ph = self.phases.setdefault(name, {'time': 0, 'calls': 0})
+        ph['calls'] += 1
+
+    def leave(self):
+        self.switch()
+        self.stack.pop()
+
+    def timed(self, name, func):
+        'func, timed as phase name'
+        def timed(*a, **kw):
+            self.enter(name)
+            try:
+                return func(*a, **kw)
+            finally:
+                self.leave()
+        return timed
+
+    def gen(self, name, it):
+        'the items of it, their production timed as phase name'
+        it = iter(it)
+        while True:
+            self.enter(name)
+            try:
+                x = next(it)
+            except StopIteration:
+                self.phases[name]['calls'] -= 1
+                return
+            finally:
+                self.leave()
+            yield x
+
+    def result(self):
+        if self.mem and self.started:
+            self.mem.stop()
+        for ph in self.phases.values():
+            ph['time'] = round(ph['time'], 6)
+        return {'time': round(self.clock() - self.t0, 6),
+                'phases': self.phases, 'counts': self.counts}
+
+def profiled(src, f):
+    '''
+    _render, with its phases timed: lines (strip_lines), fences, parse (the
+    line loop), wrap, inline (markup), emit (blockquote bars, list marks),
+    code (code blocks), layout (joining, stripping, cutting the output).
+    f.stats is the Profile result, when all chunks are consumed.
+    '''
+    p = f.prof = Profile(f.profile == 'mem')
+    c, kinds = p.counts, {B_EMPTY: 'empty', B_RULE: 'rules', B_TEXT: 'text',
+                          B_CODE: 'indented_code'}
+    def lines():
+        for l in src:
+            c['lines'] += 1
+            yield l
+    def blocks(bs):
+        for b in bs:
+            c[kinds[b[0]]] += 1
+            if b[0] == B_TEXT:
+                c['headers'] += b[3] > 0
+                c['fenced_code'] += len(b[6])
+                c['max_bq_depth'] = max(c['max_bq_depth'], b[5])
+            yield b
+    try:
+        bs = p.gen('parse', _parse(p.gen('lines', strip_lines(lines())), f))
+        chunks = _layout(blocks(bs), f)
+        if f.max_lines > 0:
+            chunks = cut_lines(chunks, f)
+        for chunk in p.gen('layout', chunks):
+            c['out_lines'] += chunk.count('\n')
+            c['out_chars'] += len(chunk)
+            yield chunk
+    finally:
+        f.prof = None
+    c['wrapped'] = p.phases.get('wrap', {}).get('calls', 0)
+    f.stats = p.result()
+
+def dump_stats(f):
+    'f.stats as JSON to stderr, for $mdvl_profile'
+    if f.stats and os.environ.get('mdvl_profile'):
+        import json, sys
+        sys.stderr.write(json.dumps(f.stats, sort_keys=True) + '\n')
+
+def src_lines(md, f):
+    'md.splitlines(), lazily with max_lines, to not split all of a long doc'
+    return iter_lines(md) if f.max_lines > 0 else md.splitlines()
+
+def iter_lines(md, size=65536):
+    'md.splitlines() as generator, splitting chunks cut after line breaks'
+    i = 0
+    while i < len(md):
+        j = md.find('\n', i + size)
+        j = len(md) if j < 0 else j + 1
+        for l in md[i:j].splitlines():
+            yield l
+        i = j
+
+def cut_lines(chunks, f):
+    '''
+    The chunks of a rendering, up to f.max_lines output lines, then the end
+    as for complete renderings (margin and color reset).
+    '''
+    n = f.max_lines + (not f.single_line_mode) # the first line is empty
+    for c in chunks:
+        ls = c.split('\n')
+        if len(ls) > n:
+            end = '' if f.single_line_mode else '\n' + margins(f)[1]
+            yield '\n'.join(ls[:n]) + end + f.colr.O
+            return
+        n -= len(ls) - 1
+        yield c
+
+def _parse(src, f):
+    '''
+    Parsing: a generator of the blocks (see B_TEXT), everything which does
+    not depend on the width: fences, block scanning, header numbering.
+    src: the lines, stripped (strip_lines).
+    '''
+    g = {} # glob parsing state (header numbers, blockquote depth)
+
+    ob, oe = f.opts_tbl_start, f.opts_tbl_end # for is_opts_tbl
+
+    # FENCED CODE BLOCKS:
+    # we take them out before all parsing, remembering them by their position
+    # in code. In the text they are replaced by code_ph lines:
+    code, code_nr = {}, itertools.count()
+    def code_ref(c):
+        nr = next(code_nr)
+        code[nr] = c
+        return code_ph % nr
+
+    g['max_bq_depth'], g['underline'] = 0, False
+
+    # LINESPROCESSOR:
+    src = extract_fences(src, code_ref)
+    if f.prof:
+        src = f.prof.gen('fences', src)
+    head = list(itertools.islice(src, max(f.header_numbering + 1, 0)))
+
+    g['header_numbering'] = False
+    if f.header_numbering > -1 and len(head) > f.header_numbering:
+        g['header_numbering'] = True
+        g['header_level'] = {} # storing the current header numberings
+
+    # remove boundary effects:
+    src = itertools.chain([''], head, src, [''])
+
+    # CLASSIFICATION: every line once, into the T_ flags. Blockquote lines
+    # get their level, mark and (classified) content stored in bq.
+    # Lines are pulled from src when needed (and forgotten when processed):
+    lines, kind, bq = [], [], []
+    def more(i):
+        'True if there is a line i, pulled from src if required'
+        while len(lines) <= i:
+            l = next(src, None)
+            if l is None:
+                return False
+            lines.append(l); kind.append(0); bq.append(None)
+            put(len(lines) - 1, l)
+        return True
+
+    def put(i, l):
+        lines[i], kind[i], bq[i] = l, classify(l, ob, oe), None
+        if l.startswith('>'):
+            lev, r, m = block_quote_status(l, g)
+            bq[i] = (lev, r, m, classify(r, ob, oe))
+
+    # BLOCKS: walking the lines with a cursor:
+    i = 0
+    while more(i):
+        if i > 1000:
+            del lines[:i], kind[:i], bq[:i]
+            i = 0
+
+        line, t = lines[i], kind[i]
+        i += 1
+        if t & T_EMPTY:
+            yield (B_EMPTY,)
+            continue
+        if debug:
+            print('procesing: ', line)
+        if t & T_RULE:
+            yield (B_RULE, h_rules_col[line[0]], g['underline'])
+            g['underline'] = False
+            continue
+
+        if t & T_INDENT: # indentd code blocks:
+            j = i
+            while more(j) and kind[j] & T_INDENT:
+                j += 1
+            cb = [l[4:] for l in lines[i-1:j]]
+            yield (B_CODE, '\n%s\n' % '\n'.join(cb))
+            i = j
+            continue
+
+        ssi = None # subseq indent for textwrap
+
+        # TEXTBLOCKS: Collect lines which must be wrapped:
+        bqm, bq_lev = '', 0 # blockquote mark. e.g. '>>'.
+        if bq[i - 1]:
+            bq_lev, line, bqm, t = bq[i - 1]
+
+        src_line_nr = 0
+
+        # we derive the (static) opts table ssi for a new textblox:
+        line, opts_tbl_ssi = is_opts_tbl(line, ob, oe)
+        # now we find all other lines belonging to that text block and
+        # collect them in parts, joined once at the end:
+        parts = [line]
+        while ( not parts[-1].endswith('  ') and
+                not is_header(parts[0]) and more(i) ):
+
+            src_line_nr += 1
+            nl, nt = lines[i], kind[i] # next line
+            if bq[i]:
+                if bq[i][0] != bq_lev:
+                    break # next line different blockquote level -> new block
+                nl, nt = bq[i][1], bq[i][3] # remove redundant '>'
+
+            # finding subseq. indent for textwrap.fill:
+
+            # Little md violation: If first word is starred, we set a ssi to
+            # position: first line second word start.
+            # Gives easy 2 col wrappable tables when first col is hilited.
+            if ssi == None:
+                # only the first two parts can decide about the line start:
+                l0 = join_parts(parts[:2]).lstrip()
+                if is_list(l0):
+                    # replace "- " and "* " with tags:
+                    parts[:2] = [list_markup[l0[:2]][0] + l0[2:]]
+                    ssi = 2
+                elif opts_tbl_ssi:
+                    ssi = opts_tbl_ssi
+                elif ( l0.startswith('*') and
+                       not f.no_smart_indent and
+                       src_line_nr == 1 ):
+                    ssi = get_subseq_light_table_indent(l0)
+
+            if nt & T_NEW:
+                break # line is now one wrapable textblock
+            parts.append(nl)
+            i += 1
+
+        line = join_parts(parts)
+        ssi = 0 if ssi is None else ssi
+        # lines are now blocks
+
+        level = 0
+        ind = len(line) - len(line.lstrip())
+        if bqm:
+            bqm += ' '
+        line = bqm + line
+
+
+        if is_header(line):
+            cont = line.lstrip('#')
+            level = len(line) - len(cont)
+            line = cont.lstrip()
+
+            u = getattr(f, 'header_underlining', '')
+            if len(u) >= level:
+                # header was one line, we reuse its slot:
+                i -= 1
+                put(i, 3 * u[level-1])
+                g['underline'] = True
+
+            if g['header_numbering']:
+                line = number_header(g['header_level'], level, line, f)
+
+        # the fenced code blocks referenced (at most one, at the start):
+        cr = {}
+        if '\x02' in line:
+            cr = dict([(n, code.pop(n)) for n in list(code)
+                       if code_ph % n in line])
+        yield (B_TEXT, line, bqm + ' ' * (ind + ssi), level, bqm,
+               g['max_bq_depth'], cr)
+
+def number_header(hl, level, line, f):
+    'hl: current numbers by level, counted up for this header'
+    hl[level] = hl.get(level, 0) + 1
+    [set(hl, k, 0) for k in hl if k > level]
+    nr = '.'.join([str(hl.get(ll, 0)) for ll in range(1, level + 1)])
+    if f.header_numb_level_max > level - 1:
+        if f.header_numb_level_min > 1:
+            nr = nr.split('.')[f.header_numb_level_min-1:]
+            nr = '.'.join(nr)
+        if nr:
+            line = nr + ' ' + line
+    return line
+
+def margins(f):
+    'the columns for the text, left and right indent'
+    cols, rindent = int(f.term_width), f.rindent
+    if f.width:
+        rindent = cols - f.indent - f.width + rindent
+    cols = cols - f.indent - rindent
+    return cols, f.indent * ' ', rindent * ' '
+
+def block_layout(f):
+    '''
+    Layout of single parsed blocks at the width of f: wrapping, colors, code
+    and blockquote bars. Returns a function of a block, giving its output
+    and if a color reset is to be appended to the previous output.
+    '''
+    C, cols = f.colr, margins(f)[0]
+    apos = chr(96) * 3 # chr 96 is backtick.
+
+    def code_fmt(c):
+        'code block, fence line reduced to the info str'
+        c = c.replace('\n', '\n%s%s %s' % (C.L, f.code_mark, C.CODE))
+        c = c.rsplit('\n', 1)[0]
+        if c.startswith(apos):
+            c = c[4:] if c[3:4] == '\n' else c[3:]
+        return c
+    code_block = lambda c: '%s%s%s' % (C.CODE, code_fmt(c), C.O)
+
+    bq_bars = {} # by level. coloring, take header levels. bq_mark is "|":
+    def bq_bar(lev):
+        if not lev in bq_bars:
+            bq_bars[lev] = ''.join([C.H(j) + f.bq_mark
+                                    for j in range(1, lev + 1)]) + C.O
+        return bq_bars[lev]
+
+    def emit(line, mx, code):
+        'all output rework of a (colored) text block'
+        # rearrange resets, to be *before* the line breaks, not after...
+        reset = line.startswith(C.O)
+        if reset:
+            line = line[len(C.O):]
+        if '\n' + C.O in line:
+            line = line.replace('\n' + C.O, C.O + '\n')
+        # ... so that we can look for blockquotes:
+        if mx and '>' in line:
+            ls = line.split('\n')
+            for k, l in enumerate(ls):
+                lev = min(mx, len(l) - len(l.lstrip('>')))
+                if lev:
+                    ls[k] = bq_bar(lev) + l[lev:]
+            line = '\n'.join(ls)
+        for k, v in list_markup.items():
+            if v[0] in line:
+                line = line.replace(v[0], getattr(C, v[1]) + v[2] + C.O)
+        # Insert back the stored code blocks:
+        if '\x02' in line:
+            ps = line.split('\x02')
+            nrs = ps[1::2]
+            if len(ps) % 2 and all([n.isdigit() for n in nrs]):
+                ps[1::2] = [code_block(code[int(n)]) for n in nrs]
+                line = ''.join(ps)
+            else: # \x02 in the source
+                line = rx(code_ph_re).sub(
+                    lambda m: code_block(code[int(m.group(1))]), line)
+        return reset, line
+
+    wrap_, markup = wrap, inline_markup
+    if f.prof: # see profiled
+        t = f.prof.timed
+        wrap_, markup = t('wrap', wrap), t('inline', inline_markup)
+        emit, code_block = t('emit', emit), t('code', code_block)
+
+    def lay(b):
+        k = b[0]
+        if k == B_EMPTY:
+            return False, ''
+        if k == B_RULE:
+            return False, getattr(C, b[1]) + (cols * f.horiz_rule)
+        if k == B_CODE:
+            return False, code_block(b[1])
+        line, s, level, bqm, mx, code = b[1:]
+        # WRAP:
+        if len(line) > cols or not narrow(line):
+            line = wrap_(line, cols, s)
+        colr = C.H(level) if level else C.O
+        if is_md_link(line):
+            colr = C.GRAY
+        return emit(colr + markup(line, C), mx, code)
+    return lay
+
+def add_block(out, kind, o, C):
+    'appends the output o (from block_layout) of a block to the out lines'
+    reset, l = o
+    if kind == B_CODE and out[-1] == '':
+        out.pop()
+    if reset:
+        out[-1] += C.O
+    out.append(l)
+
+def _layout(blocks, f):
+    '''
+    Layout of parsed blocks at the width and indents of f, a generator of
+    output chunks.
+    '''
+    C, lay = f.colr, block_layout(f)
+
+    # OUTPUT: yielding the out lines as they are complete, stripping spaces,
+    # line breaks and color resets at start and end of the document:
+    cols, li, ri = margins(f)
+    sep = '%s\n%s' % (ri, li)
+    esc = (lambda l: l.replace('\n', sep)) if li or ri else (lambda l: l)
+    pend, g = [], {'started': False} # pend: held back strippable output
+    def flush(k):
+        'yields out lines up to k, the last might still be changed'
+        for l in out[:k]:
+            if not g['started']:
+                l = strip_it(l, C.O, right=False)
+                if not l:
+                    continue
+                g['started'] = True
+                pend[:] = [li + ('' if f.single_line_mode else sep)]
+            else:
+                pend.append(sep)
+            core = strip_it(l, C.O, left=False)
+            if core:
+                pend.append(esc(core))
+                yield ''.join(pend)
+                pend[:] = [esc(l[len(core):])]
+            else:
+                pend.append(esc(l))
+        del out[:k]
+
+    out = []
+    for b in blocks:
+        add_block(out, b[0], lay(b), C)
+        for chunk in flush(len(out) - 1):
+            yield chunk
+
+    # ----------------------------- Leaving line/block scanning, document end
+    for chunk in flush(len(out)):
+        yield chunk
+    if not g['started']: # nothing but strippables
+        yield li + ('' if f.single_line_mode else sep + sep) + C.O
+    else:
+        yield ('' if f.single_line_mode else sep) + C.O
+
+def join_out(out, f):
+    'all out lines at once, as _layout yields them'
+    C, li, ri = f.colr, margins(f)[1], margins(f)[2]
+    sep = '%s\n%s' % (ri, li)
+    s = '' if f.single_line_mode else sep
+    res = strip_it('\n'.join(out), C.O)
+    if not res:
+        return li + s + s + C.O
+    return li + s + res.replace('\n', sep) + s + C.O
+
+def legacy(src, f):
+    'the rendering of _main_legacy, as one chunk'
+    import copy
+    f = copy.copy(f) # it prints and sets rindent for width
+    f.no_print = True
+    yield _main_legacy('\n'.join(src), f)
+
+def _main_legacy(md, f):
+    '''
+    engine='legacy': the original renderer, verbatim (but the lazy imports),
+    as reference for differential tests of the default engine.
+    '''
+    import re
+    from textwrap import fill
     C, cur_colr = f.colr, 'cur_colr'
     cols = int(f.term_width)
     if f.width:
@@ -406,41 +1317,660 @@ def _main(md, f):
         print (out)
     return out
 
-def strip_it(out, rst):
-    'clumsy way to strip at start at end, including color resets'
-    sc = {' ': 1, rst: len(rst), '\n': 1}
-    while 1:
-        m = False
-        for k in sc:
-            if out.startswith(k):
-                out = out[sc[k]:]
-                m = True
-            if out.endswith(k):
-                out = out[:-sc[k]]
-                m = True
-            if m:
-                break
+def strip_it(s, rst, left=True, right=True):
+    'strip spaces, line breaks and color resets at start and/or end'
+    toks, i, j = (' ', '\n', rst), 0, len(s)
+    while left and i < j:
+        m = [t for t in toks if s.startswith(t, i, j)]
         if not m:
             break
-    return out
+        i += len(m[0])
+    while right and j > i:
+        m = [t for t in toks if s.endswith(t, i, j)]
+        if not m:
+            break
+        j -= len(m[0])
+    return s[i:j]
 
 
 def main(md, **kw):
     f = Facts(md, **kw)
-    #return _main(md, f), f  # we also return to the client the config
-    if debug or f.debug:
-        return _main(md, f), f  # we also return to the client the config
+    out = _main_checked(md, f)
+    if out is not None:
+        return out, f  # we also return to the client the config
+
+def _main_checked(md, f):
+    '''
+    rendering md, errors as configured in on_error
+    '''
+    if debug or f.debug or f.on_error == 'raise':
+        return _main(md, f)
     try:
-        return _main(md, f), f  # we also return to the client the config
+        return _main(md, f)
     except Exception as ex:
+        if f.on_error == 'none':
+            return
         print (md) # clear text
         print ('md error: %s %s ' % (f.colr.CODE, ex))
 
+def render_or_clear(md, **kw):
+    'the rendering of md, at errors the clear text and the error, as printed'
+    try:
+        return main(md, **dict(kw, no_print=True, on_error='raise'))[0]
+    except Exception as ex:
+        f = Facts(md, **kw)
+        return '%s\nmd error: %s %s ' % (md, f.colr.CODE, ex)
+
 def render(md, cols, **kw):
     kw['term_width'] = cols
-    return main(md, **kw)[0]
+    out = main(md, **kw)
+    return out and out[0]
+
+def parse(md, **kw):
+    '''
+    The block tree of md, to be rendered by layout, at any width, w/o parsing
+    again. Plain data, i.e. cacheable. Config as for main.
+    '''
+    f = Facts(md, **kw)
+    blocks = _parse(strip_lines(md.splitlines()), f)
+    return {'blocks': list(blocks), 'kw': kw,
+            'single_line_mode': f.single_line_mode}
+
+def layout(tree, **kw):
+    '''
+    Rendering of a parse tree. kw override the config given to parse, e.g.
+    term_width, indent, rindent, width.
+    '''
+    kw = dict(tree['kw'], **kw)
+    f = Facts('' if tree['single_line_mode'] else '\n', **kw)
+    return ''.join(_layout(tree['blocks'], f))
+
+html_tags = {'`': ('<code>', '</code>'), '**': ('<strong>', '</strong>'),
+             '*': ('<em>', '</em>')}
+
+def render_html(md, **kw):
+    '''
+    HTML of md, from the same blocks as the terminal rendering. No wrapping
+    and colors, header numbering is kept.
+    '''
+    esc = lambda s: s.replace('&', '&amp;').replace('<', '&lt;').replace(
+                              '>', '&gt;')
+    def code_html(c):
+        import re
+        info, c = c[3:].split('\n', 1)
+        info = re.match(r'[\w+-]*', info.strip()).group() # an attr value
+        cls = ' class="language-%s"' % info if info else ''
+        return '<pre><code%s>%s</code></pre>' % (cls, esc(c[:-4]))
+
+    def text_html(line, level, code):
+        if line.startswith('\x02'): # fenced code, text might be glued to it
+            nr, line = line[1:].split('\x02', 1)
+            yield code_html(code[int(nr)])
+            line = line.strip()
+            if not line:
+                return
+        line = inline_markup(esc(line.strip()), None, html_tags)
+        if level:
+            yield '<h%s>%s</h%s>' % (level, line, level)
+        elif line[:2] in ('\x03 ', '\x04 '):
+            yield '<li>%s</li>' % line[2:]
+        else:
+            yield '<p>%s</p>' % line
+
+    out, g = [], {'ul': 0, 'blockquote': 0}
+    def tag(k, depth):
+        'opens or closes ul or (nested) blockquotes, to depth'
+        while g[k] != depth:
+            up = g[k] < depth
+            out.append(('<%s>' if up else '</%s>') % k)
+            g[k] += 1 if up else -1
+
+    for b in _parse(strip_lines(md.splitlines()), Facts(md, **kw)):
+        k = b[0]
+        if k == B_EMPTY:
+            continue
+        if k == B_TEXT:
+            line, level, bqm, code = b[1], b[3], b[4], b[6]
+            html = list(text_html(line[len(bqm):], level, code))
+            depth = len(bqm.strip())
+            if depth != g['blockquote']:
+                tag('ul', 0)
+            tag('blockquote', depth)
+            tag('ul', int(html[-1].startswith('<li>')))
+            out.extend(html)
+            continue
+        tag('ul', 0)
+        tag('blockquote', 0)
+        if k == B_CODE:
+            out.append('<pre><code>%s</code></pre>' % esc(b[1][1:-1]))
+        elif not b[2]:
+            out.append('<hr/>')
+    tag('ul', 0)
+    tag('blockquote', 0)
+    return '\n'.join(out)
+
+def render_stream(lines, **kw):
+    '''
+    Renders an iterable of lines (e.g. an open file), yielding the output in
+    chunks, as soon as the blocks are complete. Config as for main.
+    ''.join of the chunks is what main would return for the whole document.
+    '''
+    lines = iter(lines)
+    head = list(itertools.islice(lines, 2)) # enough to detect single lines
+    f = Facts(head[0] if len(head) == 1 else '\n'.join(head), **kw)
+    lines = (l for c in itertools.chain(head, lines)
+               for l in (c.splitlines() or ['']))
+    return with_stats(_render(lines, f), f) if f.profile else _render(lines, f)
+
+def with_stats(chunks, f):
+    'the chunks, then dump_stats'
+    for c in chunks:
+        yield c
+    dump_stats(f)
+
+class Renderer(object):
+    '''
+    Reusable renderer, Facts and Colors are resolved once, at init. For many
+    renderings with the same config:
+
+        r = Renderer(term_width=60, no_print=True)
+        r.render(md)
+        r.render_many([md1, md2])
+
+    For edited documents, r.update(md) re-renders only the changed blocks.
+    With profile=True (or 'mem') r.stats has the phase timings and counters
+    of the last render (see Profile).
+    '''
+    stats = None
+
+    def __init__(self, **kw):
+        # facts by single line mode:
+        self.facts = {False: Facts('\n', **kw), True: Facts('', **kw)}
+        # numbering is done after parsing, for updates:
+        self.seg_facts = Facts('\n', **dict(kw, header_numbering=-1))
+        # parsed segments, layouted blocks, output of segments in context:
+        self.segs, self.lays, self.frags = {}, {}, {}
+        self.lay = None # block_layout, on first use
+        self.lock = allocate_lock() # for the above, updates from threads
+
+    def render(self, md):
+        f = self.facts['\n' not in md]
+        if f.profile: # stats are per rendering
+            import copy
+            f = copy.copy(f)
+        out = _main_checked(md, f)
+        self.stats = f.stats
+        return out
+
+    def render_many(self, docs):
+        return [self.render(md) for md in docs]
+
+    def update(self, md):
+        '''
+        Rendering of md, reusing parsed top level blocks (see segments) and
+        block layouts of the previous update, when unchanged.
+        Header numbers and blockquote depths are applied after parsing.
+        '''
+        f = self.facts[False]
+        if not '\n' in md.strip() or f.max_lines > 0 or f.engine != 'fast':
+            return self.render(md)
+        try:
+            with self.lock:
+                out = self._update(md, f)
+        except Exception:
+            return self.render(md) # the error as configured, as main
+        if not f.no_print:
+            print (out)
+        return out
+
+    def _update(self, md, f):
+        '''
+        Segments are parsed w/o numbering (in seg_facts) and cached with
+        their header levels and if a blockquote depth from before matters.
+        Their output lines are cached by that context, blocks by their layout.
+        '''
+        sgs = list(segments(self._lines(md)))
+        n = len([sg for sg in sgs if sg is None]) + sum(
+                [sg[1] for sg in sgs if sg is not None])
+        numb = f.header_numbering > -1 and n > f.header_numbering
+        hl = {} if numb else None
+        bqmax, out, used = 0, [''], ({}, {}, {})
+        for sg in sgs:
+            if sg is None:
+                out.append('')
+                continue
+            # replacing the empty line before:
+            out[-1:] = self._frag(sg[0], hl, bqmax, f, used)
+            bqmax = max(bqmax, sg[2])
+        out.append('')
+        self.segs, self.lays, self.frags = used
+        return join_out(out, f)
+
+    def _lines(self, md):
+        'the lines of md, as strip_lines, at once'
+        lines = md.splitlines()
+        i, j = 0, len(lines)
+        while i < j and not lines[i].strip():
+            i += 1
+        while j > i and not lines[j - 1].strip():
+            j -= 1
+        lines = lines[i:j]
+        if lines:
+            lines[0], lines[-1] = lines[0].lstrip(), lines[-1].rstrip()
+        return lines
+
+    def _frag(self, lines, hl, bqmax, f, used):
+        '''
+        Output lines of a segment, after the headers counted in hl (advanced,
+        None: no numbering) and a blockquote depth bqmax. The first line is
+        the empty one before.
+        used: the caches (segs, lays, frags) to keep after this rendering.
+        '''
+        C, (segs, lays, frags) = f.colr, used
+        def layout(b):
+            k = b if b[0] != B_TEXT else b[:6] + tuple(sorted(b[6].items()))
+            o = lays[k] = lays.get(k) or self.lays.get(k)
+            if o is None:
+                self.lay = self.lay or block_layout(f)
+                o = lays[k] = self.lay(b)
+            return o
+
+        k = '\n'.join(lines)
+        p = segs[k] = segs.get(k) or self.segs.get(k)
+        if p is None:
+            bs = list(_parse(lines, self.seg_facts))[1:-1]
+            p = segs[k] = (bs, tuple([b[3] for b in bs
+                                      if b[0] == B_TEXT and b[3]]),
+                           any([b[0] == B_TEXT and '>' in b[1] for b in bs]))
+        bs, levels, gt = p
+        numb = hl is not None
+        ctx = (k, gt and bqmax, numb and levels and tuple(sorted(hl.items())))
+        frag = frags.get(ctx) or self.frags.get(ctx)
+        if frag is None:
+            frag = ['']
+            for b in bs:
+                if b[0] == B_TEXT:
+                    if b[3] and numb:
+                        b = (B_TEXT, number_header(dict(hl), b[3], b[1], f)
+                             ) + b[2:]
+                    if bqmax:
+                        b = b[:5] + (max(bqmax, b[5]), b[6])
+                add_block(frag, b[0], layout(b), C)
+                if b[0] == B_TEXT and b[3] and numb:
+                    number_header(hl, b[3], '', f)
+        elif numb:
+            [number_header(hl, l, '', f) for l in levels]
+        frags[ctx] = frag
+        return frag
+
+
+class Pager(Renderer):
+    '''
+    Lazy rendering of a (large) document, for viewing. A pre pass indexes
+    the segments w/o parsing: their source line, the header numbers and
+    blockquote depth before them, and the headers. Segments are rendered
+    only when in view (plus prefetch ones after).
+    Positions in the output are (segment nr, line within its output).
+
+        p = Pager(md, term_width=80)
+        p.view(p.find_header('Usage'), 40) # 40 screen lines
+    '''
+    def __init__(self, md, prefetch=2, **kw):
+        Renderer.__init__(self, **dict(kw, no_print=True))
+        f, self.prefetch, self.out = self.facts[False], prefetch, {}
+        nr = md[:len(md) - len(md.lstrip())].count('\n') # stripped
+        # index: (source line, lines, header levels, bq depth, empty lines
+        # before) by segment. heads: (segment nr, header line):
+        self.index, self.heads, bqmax, n = [], [], 0, 0
+        for sg in segments(self._lines(md)):
+            if sg is None:
+                nr, n = nr + 1, n + 1
+                continue
+            seps = nr - self.index[-1][0] - len(self.index[-1][1]) - 1 \
+                    if self.index else 0
+            lev = [len(h) - len(h.lstrip('#')) for h in sg[3]]
+            self.index.append((nr, sg[0], lev, bqmax, seps))
+            self.heads.extend([(len(self.index) - 1, h) for h in sg[3]])
+            nr, n, bqmax = nr + len(sg[0]), n + sg[1], max(bqmax, sg[2])
+        self.lines = nr # of the source
+        # header numbers before each segment:
+        self.numb = f.header_numbering > -1 and n > f.header_numbering
+        self.hls, hl = [], {}
+        for s in self.index if self.numb else ():
+            self.hls.append(dict(hl))
+            [number_header(hl, l, '', f) for l in s[2]]
+
+    def segment(self, i):
+        'the output lines of segment i, rendered once'
+        o = self.out.get(i)
+        if o is None:
+            f = self.facts[False]
+            nr, lines, lev, bqmax, seps = self.index[i]
+            hl = dict(self.hls[i]) if self.numb else None
+            used = (self.segs, self.lays, self.frags) # all are kept
+            o = '\n'.join([''] * seps + self._frag(lines, hl, bqmax, f,
+                                                   used))
+            # as join_out:
+            o = strip_it(o, f.colr.O, left=i == 0,
+                         right=i == len(self.index) - 1)
+            li, ri = margins(f)[1:]
+            o = self.out[i] = [li + l + ri for l in o.split('\n')]
+        return o
+
+    def view(self, pos, rows):
+        '''
+        rows screen lines (see screen_lines) from pos on, less at the end.
+        Renders the segments required plus prefetch ones.
+        '''
+        i, k = pos
+        ls, j = [], i
+        while len(ls) < k + rows and j < len(self.index):
+            ls.extend(self.segment(j))
+            j += 1
+        [self.segment(m) for m in range(j, min(j + self.prefetch,
+                                               len(self.index)))]
+        return screen_lines('\n'.join(ls))[k:k + rows] if ls else []
+
+    def move(self, pos, d):
+        'pos moved by d output lines, within the document'
+        if not self.index:
+            return pos
+        i, k = pos[0], pos[1] + d
+        while k < 0 and i > 0:
+            i -= 1
+            k += len(self.segment(i))
+        while k >= len(self.segment(i)) and i < len(self.index) - 1:
+            k -= len(self.segment(i))
+            i += 1
+        return i, max(0, min(k, len(self.segment(i)) - 1))
+
+    def end(self, rows):
+        'position showing the last rows lines'
+        i = len(self.index) - 1
+        return self.move((i, len(self.segment(i)) - 1), 1 - rows) \
+                if i > -1 else (0, 0)
+
+    def find_line(self, nr):
+        'position of the segment with source line nr (from 0)'
+        from bisect import bisect
+        return max(bisect([s[0] for s in self.index], nr) - 1, 0), 0
+
+    def find_header(self, s, pos=(-1, 0)):
+        'position of the next segment after pos with a header containing s'
+        for i, h in self.heads:
+            if i > pos[0] and s in h:
+                return i, 0
+
+    def src_line(self, pos):
+        'the source line of a position (first of its segment)'
+        return self.index[pos[0]][0] if self.index else 0
+
+
+def cache_dir():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                        os.path.expanduser('~/.cache'), 'mdvl')
+
+def file_key(fn, f, *a):
+    'cache key of file fn (path, mtime, size), config f and a'
+    st = os.stat(fn)
+    return cache_key(repr((os.path.abspath(fn), st.st_mtime, st.st_size) + a),
+                     f)
+
+def render_file(fn, **kw):
+    '''
+    Rendering of a markdown file, with a disk cache under $XDG_CACHE_HOME.
+    Entries are found by path, mtime and size of the file plus the config,
+    i.e. a hit costs a stat and a file read. No print, None on errors.
+    '''
+    kw['no_print'] = True
+    kw.setdefault('on_error', 'none') # the cli renders again, showing it
+    f = Facts('\n', **kw) # for the key. content decides single_line_mode
+    def render():
+        with open(fn) as fd:
+            md = fd.read()
+        out = main(md, **kw)
+        return out and out[0]
+    return disk_cached(file_key(fn, f), f, render)
+
+def tmp_name(fn):
+    'for writing then renaming to fn, unique per process and thread'
+    return '%s.%s.%s.tmp' % (fn, os.getpid(), get_ident())
+
+def disk_cached(k, f, make):
+    '''
+    The str make() returns, stored in the disk cache under key k (when
+    f.disk_cache_bytes > 0), returned from there while present.
+    '''
+    d = cache_dir()
+    cfn = os.path.join(d, k)
+    if f.disk_cache_bytes > 0 and not f.profile and os.path.exists(cfn):
+        os.utime(cfn, None) # eviction is by least recent use
+        with open(cfn, 'rb') as fd:
+            out = fd.read()
+        return out.decode('utf-8')
+    out = make()
+    if out is None or f.disk_cache_bytes <= 0:
+        return out
+    try:
+        if not os.path.exists(d):
+            os.makedirs(d)
+        tmp = tmp_name(cfn)
+        with open(tmp, 'wb') as fd:
+            fd.write(to_bytes(out))
+        os.rename(tmp, cfn) # atomic, for concurrent mdvls
+        evict(d, f.disk_cache_bytes)
+    except (IOError, OSError) as ex: # cache is optional
+        if debug:
+            print('cache error: %s' % ex)
+    return out
 
-def get_help(cols, PY2):
+def evict(d, max_bytes):
+    'removes least recently used files in d until they sum up to max_bytes'
+    fns = [os.path.join(d, fn) for fn in os.listdir(d)]
+    st = sorted([(os.stat(fn), fn) for fn in fns], key=lambda s: s[0].st_mtime)
+    total = sum([s.st_size for s, fn in st])
+    for s, fn in st:
+        if total <= max_bytes:
+            break
+        os.unlink(fn)
+        total -= s.st_size
+
+# mdvl FILE --section 2.3 | --toc: an index of the headers of a file, in a
+# sidecar file of the disk cache. Sections are read via mmap, only their
+# bytes are decoded and rendered.
+head_re = b'(?m)^(#|```|~~~)' # header or fence lines
+
+def section_index(fn, **kw):
+    '''
+    The headers of file fn: {'heads': [(level, number, text, text with the
+    number shown, start, end)], 'numbered': header numbering is on}. start,
+    end: byte offsets of the section, up to the next header of the same or
+    a higher level. Stored in a sidecar, valid for the mtime and size of fn.
+    '''
+    import hashlib
+    f, st = Facts('\n', **kw), os.stat(fn)
+    key = repr((__version__, st.st_mtime, st.st_size, f.header_numbering,
+                f.header_numb_level_min, f.header_numb_level_max))
+    d = cache_dir()
+    cfn = os.path.join(d, hashlib.sha1(to_bytes(os.path.abspath(fn))
+                                       ).hexdigest() + '.idx')
+    # sidecar: key, numbered, then per header (text last, might have tabs):
+    # level, number, start, end, number shown (prefix of text), text:
+    if f.disk_cache_bytes > 0 and os.path.exists(cfn):
+        with open(cfn, 'rb') as fd:
+            ls = fd.read().decode('utf-8').split('\n')
+        if ls[0] == key:
+            os.utime(cfn, None)
+            return {'numbered': ls[1] == '1', 'heads': [
+                (int(h[0]), h[1], h[5], h[4] + h[5], int(h[2]), int(h[3]))
+                for h in [l.split('\t', 5) for l in ls[2:]]]}
+    idx = {'heads': [], 'numbered': False}
+    if st.st_size:
+        import mmap
+        with open(fn, 'rb') as fd:
+            m = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                idx = index_headers(m, f)
+            finally:
+                m.close()
+    if f.disk_cache_bytes <= 0:
+        return idx
+    try:
+        if not os.path.exists(d):
+            os.makedirs(d)
+        tmp = tmp_name(cfn)
+        with open(tmp, 'wb') as fd:
+            fd.write(to_bytes('\n'.join([key, str(int(idx['numbered']))] + [
+                '%s\t%s\t%s\t%s\t%s\t%s' % (h[0], h[1], h[4], h[5],
+                                       h[3][:len(h[3]) - len(h[2])], h[2])
+                for h in idx['heads']])))
+        os.rename(tmp, cfn)
+        evict(d, f.disk_cache_bytes)
+    except (IOError, OSError) as ex: # cache is optional
+        if debug:
+            print('cache error: %s' % ex)
+    return idx
+
+def index_headers(m, f):
+    '''
+    section_index of the document in bytes (or mmap) m. Header and fence
+    lines are found by regex, the rest is not looked at, except for counting
+    the lines, which decides about header numbering (as in _parse).
+    '''
+    heads, hl, fence, fs, n, open_ = [], {}, None, 0, 0, []
+    first, last, mb = rx(br'\S').search(m), len(m), 1 << 20
+    if not first:
+        return {'heads': heads, 'numbered': False}
+    # lines of the document, w/o leading and trailing empty ones:
+    while m[last - 1:last].isspace():
+        last -= 1
+    n += sum([m[k:min(k + mb, last)].count(b'\n')
+              for k in range(first.start(), last, mb)]) + 1
+    # candidates: line starts matching, the first line is lstripped:
+    for i in itertools.chain([first.start()], [
+            mt.start() for mt in rx(head_re).finditer(m, first.start() + 1)]):
+        j = m.find(b'\n', i)
+        j = len(m) if j < 0 else j
+        l = m[i:j].decode('utf-8', 'replace').rstrip('\r')
+        if fence:
+            if fence_end(l, fence):
+                n -= m[fs:i].count(b'\n') # a block is one line
+                fence = None
+            continue
+        if l[:3] in ('```', '~~~'):
+            fence, fs = fence_start(l), i
+            continue
+        if l[:1] != '#':
+            continue
+        text = l.lstrip('#')
+        level, text = len(l) - len(text), text.lstrip()
+        shown = number_header(hl, level, text, f)
+        nr = '.'.join([str(hl.get(k, 0)) for k in range(1, level + 1)])
+        while open_ and heads[open_[-1]][0] >= level: # sections ending
+            heads[open_.pop()][5] = i
+        open_.append(len(heads))
+        heads.append([level, nr, text, shown, i, len(m)])
+    if fence: # unclosed, up to the end
+        n -= m[fs:last].count(b'\n')
+    return {'heads': [tuple(h) for h in heads],
+            'numbered': -1 < f.header_numbering < n}
+
+def render_section(fn, sect, **kw):
+    '''
+    Rendering of section sect of file fn, given by its number (e.g. "2.3")
+    or a part of its header text, None if not found. Only the bytes of the
+    section are read. Header numbers are the ones of the whole document.
+    '''
+    idx = section_index(fn, **kw)
+    hs = [h for h in idx['heads'] if h[1] == sect] or [
+            h for h in idx['heads'] if sect.lower() in h[2].lower()]
+    if not hs:
+        return
+    import mmap
+    start, end = hs[0][4:]
+    with open(fn, 'rb') as fd:
+        m = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            md = m[start:end]
+        finally:
+            m.close()
+    if idx['numbered']: # numbers into the header lines, rendered w/o numbering
+        parts, i = [], 0
+        for h in idx['heads']:
+            if start <= h[4] < end:
+                j = md.find(b'\n', h[4] - start)
+                parts += [md[i:h[4] - start], to_bytes('#' * h[0] + ' ' + h[3])]
+                i = len(md) if j < 0 else j
+        md = b''.join(parts) + md[i:]
+    out = main(md.decode('utf-8'), **dict(kw, header_numbering=-1,
+                                          no_print=True))
+    return out and out[0]
+
+def toc(fn, **kw):
+    'outline of fn, from its section index, with the full numbers'
+    f = Facts('\n', **kw)
+    C, li = f.colr, margins(f)[1]
+    return '\n'.join([li + '  ' * (h[0] - 1) + C.H(h[0]) + h[1] + ' ' * (
+            h[1] != '') + h[2].strip() + C.O for h in section_index(
+                fn, **kw)['heads']])
+
+def render_files(src_dir, out_dir, workers=None, **kw):
+    '''
+    Renders all .md files below src_dir into out_dir, same tree, as .ansi
+    files. Work is distributed in chunks over a process pool of workers
+    (default: cpu count, 1: in process). Outputs newer than their source are
+    skipped. Returns counts of files (rendered), skipped, errors, source
+    bytes, secs.
+    '''
+    import time
+    t0, jobs, skipped = time.time(), [], 0
+    for d, dirs, fns in os.walk(src_dir):
+        for fn in sorted(fns):
+            if not fn.endswith('.md'):
+                continue
+            src = os.path.join(d, fn)
+            dst = os.path.join(out_dir, os.path.relpath(src, src_dir))[:-3]
+            dst += '.ansi'
+            if (os.path.exists(dst) and
+                    os.stat(dst).st_mtime >= os.stat(src).st_mtime):
+                skipped += 1
+                continue
+            jobs.append((src, dst, kw))
+    workers = workers or (os.cpu_count() if hasattr(os, 'cpu_count') else 1)
+    if workers == 1 or len(jobs) < 2:
+        res = [render_job(j) for j in jobs]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(workers) as pool:
+            cs = max(1, len(jobs) // (workers * 4))
+            res = list(pool.map(render_job, jobs, chunksize=cs))
+    return {'files': len([r for r in res if r is not None]),
+            'skipped': skipped, 'errors': len([r for r in res if r is None]),
+            'bytes': sum([r for r in res if r]), 'secs': time.time() - t0}
+
+def render_job(job):
+    'renders one file of render_files, written atomically. Source size'
+    src, dst, kw = job
+    try:
+        with open(src) as fd:
+            md = fd.read()
+        out = main(md, **dict(kw, no_print=True, on_error='raise'))
+        d = os.path.dirname(dst)
+        if not os.path.exists(d):
+            try:
+                os.makedirs(d)
+            except OSError: # other worker
+                pass
+        tmp = tmp_name(dst)
+        with open(tmp, 'wb') as fd:
+            fd.write(to_bytes(out[0]))
+        os.rename(tmp, dst)
+        return len(to_bytes(md))
+    except Exception as ex: # e.g. unreadable, not utf-8: this file only
+        print('md error: %s: %s' % (src, ex))
+
+
+def get_help(cols):
     ff = Facts('\n', term_width=cols)
     md, C = __doc__, ff.colr
     for o in ff, C:
@@ -448,49 +1978,497 @@ def get_help(cols, PY2):
         for k, d in sorted(o._parms):
             v = getattr(o, k)
             if o == ff: # need the perceived len here:
-                v = C.H2 + (str(u'%5s' % str(v)) if PY2 else '%5s' % v) + C.O
+                v = C.H2 + '%5s' % v + C.O
             mmd += ('%s %s [%s]' % (v, k, d),)
         md = md % ('\n'.join(mmd))
     return md
 
-# allow to adapt $COLUMNS by setting $term_width:
-get_cols = lambda: (env('term_width')                      or
-          os.popen('tput cols 2>/dev/null').read().strip() or '80' )
+def term_size(fd):
+    '(columns, lines) of the terminal at fd, w/o forking tput'
+    return tuple(os.get_terminal_size(fd))
+
+term_cols = lambda fd: term_size(fd)[0]
+
+def get_cols():
+    'allow to adapt the terminal width by setting $term_width, else $COLUMNS'
+    if env('term_width'):
+        return env('term_width')
+    for fd in 2, 1, 0: # stdout might be a pipe, e.g. to less
+        try:
+            cols = term_cols(fd)
+            if cols:
+                return str(cols)
+        except Exception:
+            pass
+    return os.environ.get('COLUMNS') or '80'
 
 def sys_main():
     import sys
-    PY2 = sys.version_info[0] == 2
-    if PY2:
-        reload(sys); sys.setdefaultencoding('utf-8')
-    import os
     from stat import S_ISFIFO
+    argv, pipe = sys.argv[1:], S_ISFIFO(os.fstat(0).st_mode)
+    if argv[:1] == ['--serve']:
+        return serve()
+    if argv[:1] in (['--watch'], ['--page']): # interactive, never forwarded
+        if len(argv) != 2 or not os.path.isfile(argv[1]):
+            return print('usage: mdvl %s FILE' % argv[0])
+        return (watch if argv[0] == '--watch' else page)(argv[1])
     err = None
     try:
         cols = get_cols()
     except Exception as ex:
         err = str(ex)
         cols = 80
-    if S_ISFIFO(os.fstat(0).st_mode): # pipe mode
-        md = sys.stdin.read()
+    # -f runs the user's scripts, i.e. needs all of the environ:
+    if not (err or debug or os.environ.get('mdvl_profile')) and argv[:1] != [
+            '-f'] and client(argv, cols, pipe):
+        return
+    cli(argv, cols, pipe, err)
+
+def cli(argv, cols, pipe, err=None):
+    'the command line: markdown (file) from argv or stdin (pipe) to stdout'
+    import sys
+    if argv[:2] == ['-f', '--index']:
+        return func_search(argv[2:], cols)
+    if argv[:1] == ['-f']:
+        return format_file(*argv[1:])
+    if argv[:1] == ['--batch']:
+        return batch(argv[1:], cols)
+    if '--toc' in argv or '--section' in argv:
+        return sections(argv, cols)
+    kw = {'term_width': cols}
+    if '--head' in argv: # mdvl ... --head N: only the first N lines
+        i = argv.index('--head')
+        if not argv[i + 1:i + 2] or not argv[i + 1].isdigit():
+            return print('usage: mdvl <md or file> --head N')
+        kw['max_lines'], argv = int(argv[i + 1]), argv[:i] + argv[i + 2:]
+    if argv[:1] == ['--html']:
+        md = argv[1]
+        if os.path.exists(md):
+            with open(md) as fd:
+                md = fd.read()
+        return print(render_html(md))
+    if pipe: # streaming
+        err and print(err)
+        try:
+            for chunk in render_stream(iter(sys.stdin.readline, ''), **kw):
+                sys.stdout.write(chunk)
+                sys.stdout.flush()
+            print('')
+        except Exception as ex:
+            print ('md error: %s' % ex)
+        return
     else:
-        if not len(sys.argv) > 1 or '-h' in sys.argv:
-            md = get_help(cols, PY2)
+        if not argv or '-h' in argv:
+            md = get_help(cols)
         else:
-            md = sys.argv[1]
+            md = argv[0]
+        if os.path.exists(md) and not err:
+            out = render_file(md, **kw)
+            if out is not None:
+                print(out)
+                return
         if os.path.exists(md):
             with open(md) as fd:
                 md = fd.read()
     if err:
         print(err)
-        print md
+        print(md)
     else:
-        main(md, term_width=cols)
+        main(md, **dict(kw, on_error='print'))
+
+def batch(argv, cols):
+    'mdvl --batch SRC_DIR --out OUT_DIR [--workers N]'
+    opt = lambda k, d: argv[argv.index(k) + 1] if k in argv else d
+    if not argv or not '--out' in argv:
+        print('usage: ' + batch.__doc__)
+        return
+    r = render_files(argv[0], opt('--out', None),
+                     int(opt('--workers', 0)), term_width=cols)
+    secs = max(r['secs'], 1e-6)
+    print('%(files)s files rendered, %(skipped)s unchanged, %(errors)s errors'
+          % r + ' - %.1fs, %.1f files/s, %.2f MB/s' % (
+              secs, r['files'] / secs, r['bytes'] / secs / 1e6))
+
+# ---------------------------------------------------------------- Watch Mode
+# mdvl --watch FILE: live preview. Re-renders (Renderer.update) at changes of
+# the file or the terminal size and rewrites only the screen lines which
+# differ, via cursor addressing - no clear, no flicker, little to send.
+sgr_re = '\x1b\\[[0-9;]*m'
+
+def screen_lines(out):
+    'lines of a rendering, each prefixed with the color active at its start'
+    sgr, res = '', []
+    for l in out.split('\n'):
+        res.append(sgr + l)
+        if '\x1b[' in l:
+            sgr = rx(sgr_re).findall(l)[-1]
+            sgr = '' if sgr == Colors.O else sgr
+    return res
+
+def repaint(old, new):
+    '''
+    Escapes turning screen lines old into new: writes only the lines which
+    differ, each at its position, and clears those not present any more.
+    '''
+    r = []
+    for i in range(max(len(old), len(new))):
+        l = new[i] if i < len(new) else ''
+        if l != (old[i] if i < len(old) else ''):
+            r.append('\x1b[%s;1H\x1b[0m%s\x1b[0m\x1b[K' % (i + 1, l))
+    return ''.join(r)
+
+def inotify(d):
+    'non blocking inotify fd, watching writes and renames in dir d, or None'
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK) # == IN_NONBLOCK
+    except Exception: # not linux
+        return None
+    # IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE:
+    if fd > -1 and libc.inotify_add_watch(fd, to_bytes(d), 0x182) < 0:
+        os.close(fd)
+        fd = -1
+    return fd if fd > -1 else None
+
+def file_changes(fn, interval=0.2, wake=None):
+    '''
+    Yields True after each change of fn, False at other wakeups (from fd
+    wake, e.g. a signal). Waits for inotify events in the dir of fn (editors
+    replace files) where available, else polls with os.stat.
+    '''
+    import select
+    ino = inotify(os.path.dirname(os.path.abspath(fn)))
+    fds = [fd for fd in (ino, wake) if fd is not None]
+    last = None
+    while True:
+        try:
+            st = os.stat(fn)
+            sig = (st.st_mtime, st.st_size, st.st_ino)
+        except OSError: # in the middle of being replaced
+            sig = last
+        yield sig != last
+        last = sig
+        try:
+            r = select.select(fds, [], [], interval if ino is None else 5)[0]
+            [os.read(fd, 65536) for fd in r]
+        except OSError: # EINTR
+            pass
+
+# alternate screen, no cursor, no autowrap (long lines are cut) - and back:
+full_screen = ('\x1b[?1049h\x1b[?25l\x1b[?7l', '\x1b[?7h\x1b[?25h\x1b[?1049l')
+
+def on_resize(g):
+    'sets g["resized"] at SIGWINCH. Returns an fd to select, readable then'
+    import signal, fcntl
+    signal.signal(signal.SIGWINCH, lambda *a: set(g, 'resized', True))
+    wake = os.pipe()
+    for fd in wake:
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) |
+                    os.O_NONBLOCK)
+    signal.set_wakeup_fd(wake[1])
+    return wake[0]
+
+def screen_rows(out):
+    try:
+        return term_size(out.fileno())[1]
+    except Exception:
+        return int(os.environ.get('LINES') or 24)
+
+def watch(fn, interval=0.2, out=None):
+    '''
+    Renders fn into the alternate screen, showing its top, until Ctrl-C.
+    Repaints at changes of the file and at resizes (SIGWINCH).
+    '''
+    import sys
+    out, g = out or sys.stdout, {'resized': True}
+    wake = on_resize(g)
+    out.write(full_screen[0])
+    shown = None
+    try:
+        for changed in file_changes(fn, interval, wake):
+            if g['resized']:
+                g['resized'], shown = False, None
+                rows = screen_rows(out)
+                r = Renderer(term_width=get_cols(), no_print=True)
+            elif not changed:
+                continue
+            try:
+                with open(fn) as fd:
+                    md = fd.read()
+            except IOError:
+                continue
+            try:
+                lines = screen_lines(r.update(md) or '')[:rows]
+            except Exception as ex: # e.g. while typing, shown until fixed
+                lines = screen_lines('%s\nmd error: %s' % (md, ex))[:rows]
+            out.write(('\x1b[2J' if shown is None else '') +
+                      repaint(shown or [], lines))
+            out.flush()
+            shown = lines
+    except KeyboardInterrupt:
+        pass
+    finally:
+        out.write(full_screen[1])
+        out.flush()
+
+
+# --------------------------------------------------------------------- Pager
+# mdvl --page FILE: renders only the segments in view (see Pager), repaints
+# as watch does.
+key_re = '(?s)\x1b\\[[0-9]*[~A-D]|.'
+# scroll keys: (lines, pages):
+page_keys = {'j': (1, 0), '\r': (1, 0), '\n': (1, 0), '\x1b[B': (1, 0),
+             'k': (-1, 0), '\x1b[A': (-1, 0), ' ': (0, 1), 'f': (0, 1),
+             '\x1b[6~': (0, 1), 'b': (0, -1), '\x1b[5~': (0, -1),
+             'd': (0, .5), 'u': (0, -.5)}
+
+def page(fn, out=None):
+    '''
+    Interactive pager for fn. Keys: j, k, arrows, space, b, d, u, PgDn,
+    PgUp: scroll. g, G: start, end. /<text>: next header with text, n: next
+    one. :<nr>: to source line nr. q: quit.
+    '''
+    import select, termios, tty, sys
+    out, g = out or sys.stdout, {'resized': True}
+    with open(fn) as fd:
+        md = fd.read()
+    if not os.isatty(0):
+        return main(md, term_width=get_cols(), on_error='print')
+    wake, tc = on_resize(g), termios.tcgetattr(0)
+    tty.setcbreak(0)
+    out.write(full_screen[0])
+    p, shown, pos, keys = None, None, (0, 0), []
+    prompt, search, msg = None, '', '' # prompt: the / or : command typed
+    try:
+        while True:
+            if g['resized']:
+                g['resized'], shown = False, None
+                rows = screen_rows(out) - 1 # status line
+                nr = p.src_line(pos) if p else 0
+                p = Pager(md, term_width=get_cols())
+                pos = p.find_line(nr)
+            for k in keys:
+                n, msg = False, '' # n: position found by a command
+                if prompt is not None:
+                    if k == '\x7f':
+                        prompt = prompt[:-1] or None
+                    elif k == '\x1b':
+                        prompt = None
+                    elif k not in ('\r', '\n'):
+                        prompt += k
+                    elif prompt[0] == '/':
+                        search, prompt = prompt[1:], None
+                        n = p.find_header(search, pos)
+                    else:
+                        n = p.find_line(int(prompt[1:]) - 1) \
+                                if prompt[1:].isdigit() else None
+                        prompt = None
+                elif k == 'q':
+                    return
+                elif k in ('/', ':'):
+                    prompt = k
+                elif k == 'n' and search:
+                    n = p.find_header(search, pos)
+                elif k == 'g':
+                    pos = (0, 0)
+                elif k == 'G':
+                    pos = p.end(rows)
+                elif k in page_keys:
+                    d = page_keys[k]
+                    pos = p.move(pos, d[0] + int(d[1] * rows))
+                if n is not False:
+                    pos, msg = n or pos, '' if n else 'not found'
+            lines = p.view(pos, rows)
+            status = prompt if prompt is not None else \
+                    '\x1b[7m %s %s/%s %s\x1b[0m' % (fn, p.src_line(pos) + 1,
+                                                  p.lines, msg)
+            lines += [''] * (rows - len(lines)) + [status]
+            out.write(('\x1b[2J' if shown is None else '') +
+                      repaint(shown or [], lines))
+            out.flush()
+            shown = lines
+            keys = []
+            try:
+                r = select.select([0, wake], [], [])[0]
+            except OSError: # EINTR
+                r = []
+            if wake in r:
+                os.read(wake, 64)
+            if 0 in r:
+                k = os.read(0, 64).decode('utf-8', 'replace')
+                keys = rx(key_re).findall(k)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        termios.tcsetattr(0, termios.TCSADRAIN, tc)
+        out.write(full_screen[1])
+        out.flush()
+
+
+def sections(argv, cols):
+    'mdvl FILE --toc | mdvl FILE --section <number or header text>'
+    fns = [a for a in argv if os.path.isfile(a)]
+    if not fns or '--section' in argv[-1:]:
+        return print('usage: ' + sections.__doc__)
+    if '--toc' in argv:
+        return print(toc(fns[0], term_width=cols))
+    sect = argv[argv.index('--section') + 1]
+    try:
+        out = render_section(fns[0], sect, term_width=cols)
+    except Exception as ex:
+        return print('md error: %s' % ex)
+    print('no section %s' % sect if out is None else out)
+
+# ------------------------------------------------------------- Render Daemon
+# mdvl --serve keeps a warm interpreter, mdvl calls are forwarded to it.
+# Protocol: client sends repr of the request dict and a newline, the server
+# answers one byte: '0' (served) or '1' (render yourself). Then the client
+# streams stdin (pipe mode), the server the output, until closing.
+def socket_path():
+    'per user unix socket, in a private dir (see private)'
+    return os.environ.get('mdvl_socket') or os.path.join(
+            os.environ.get('XDG_RUNTIME_DIR') or '/tmp/mdvl-%s' % os.getuid(),
+            'mdvl.sock')
+
+def private(path, sock=False):
+    'dir (or socket in a dir) is ours, the dir not writable by others'
+    uid = os.getuid()
+    try:
+        if sock:
+            if os.stat(path).st_uid != uid:
+                return False
+            path = os.path.dirname(path) or '.'
+        st = os.stat(path)
+    except OSError:
+        return False
+    return st.st_uid == uid and not st.st_mode & 0o022
+
+def client_env():
+    'the part of the environ the rendering reads, for the daemon'
+    ks = [k for c in (Facts, Colors) for k in dir(c) if not k.startswith('_')]
+    ks += list(Colors._env_dflt.values()) + [
+            'COLUMNS', 'LINES', 'HOME', 'XDG_CACHE_HOME', 'mdvl_debug',
+            'mdvl_profile', 'mdvl_engine']
+    return dict([(k, os.environ[k]) for k in ks if k in os.environ])
+
+def client(argv, cols, pipe):
+    'renders via a running mdvl --serve, False if there is none'
+    import _socket, select, sys # not socket, which imports enum
+    path = socket_path()
+    if not private(path, sock=True): # not running - or someone else's
+        return False
+    s = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    s.settimeout(1) # a stopped daemon still accepts (listen backlog)
+    try:
+        s.connect(path)
+        req = {'argv': argv, 'cols': cols, 'pipe': pipe, 'cwd': os.getcwd(),
+               'env': client_env()}
+        s.sendall(to_bytes(repr(req) + '\n'))
+        if s.recv(1) != b'0':
+            return False
+    except Exception:
+        s.close()
+        return False
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    ins, pend = [0] if pipe else [], b''
+    if not pipe:
+        s.shutdown(_socket.SHUT_WR)
+    s.setblocking(0) # we select, and must never block sending stdin
+    while True:
+        r, w = select.select([s] + ins, [s] if pend else [], [])[:2]
+        if ins and ins[0] in r and not pend:
+            pend = os.read(0, 65536)
+            if not pend:
+                ins = []
+                s.shutdown(_socket.SHUT_WR)
+        if w:
+            pend = pend[s.send(pend):]
+        if s in r:
+            d = s.recv(65536)
+            if not d:
+                break
+            out.write(d)
+            out.flush()
+    s.close()
+    return True
+
+def serve(path=None):
+    '''
+    renders the requests of clients, each in a forked child: a slow one
+    (e.g. a pipe) does not block the others
+    '''
+    import socket, signal, sys
+    signal.signal(signal.SIGTERM, lambda *a: sys.exit(0)) # rm the socket
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN) # no zombies, no reaping
+    path = path or socket_path()
+    d = os.path.dirname(path) or '.'
+    if not os.path.exists(d):
+        os.mkdir(d, 0o700)
+    if not private(d):
+        print('mdvl not serving: %s is not private' % d)
+        return
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.exists(path):
+        try:
+            s.connect(path)
+            print('mdvl already serving at %s' % path)
+            return
+        except socket.error: # stale
+            os.unlink(path)
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.bind(path)
+    os.chmod(path, 0o600)
+    s.listen(16)
+    print('mdvl serving at %s' % path)
+    sys.stdout.flush()
+    try:
+        while True:
+            conn = s.accept()[0]
+            if os.fork():
+                conn.close()
+                continue
+            # child: serves conn only, must not remove the socket at exit
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL) # e.g. subprocess
+            s.close()
+            try:
+                serve_one(conn)
+            except Exception as ex: # the client is gone, no one to tell
+                if debug:
+                    print('serve error: %s' % ex)
+            finally:
+                conn.close()
+                os._exit(0)
+    finally:
+        os.unlink(path)
+
+def serve_one(conn):
+    import ast, sys
+    rf = conn.makefile('r', encoding='utf-8')
+    wf = conn.makefile('w', encoding='utf-8')
+    req = ast.literal_eval(rf.readline())
+    conn.sendall(b'0')
+    old = sys.stdin, sys.stdout, dict(os.environ), os.getcwd()
+    sys.stdin, sys.stdout = rf, wf
+    os.environ.clear()
+    os.environ.update(req['env'])
+    try:
+        os.chdir(req['cwd'])
+        cli(req['argv'], req['cols'], req['pipe'])
+        wf.flush()
+    finally:
+        sys.stdin, sys.stdout = old[:2]
+        os.environ.clear()
+        os.environ.update(old[2])
+        os.chdir(old[3])
+        rf.close(), wf.close()
 
 # ==============================================  Script Formatters ===========
 
 def format_bash(dev_help, cols, lines, script, *args):
     '''
-    Renders help for a bash script nicely, given it follows some conventions.
+    Prints help for a bash script nicely, given it follows some conventions.
 
     These are:
 
@@ -520,56 +2498,50 @@ def format_bash(dev_help, cols, lines, script, *args):
         }
 
     '''
-    dev_help = True if str(dev_help) in ('True', 'true', '1') else False
-    single_func_doc=False; l = lines; funcs = []
-    start = ": '"
-    is_func     = lambda l: l.startswith('function ')
-    is_cmt_end  = lambda l: l.rstrip().endswith("'")
-    is_cmt_start= lambda l: l.lstrip().startswith(start)
-
-    def clean(s, head_sub):
-        s = s.strip()
-        s = s[len(start):] if s.startswith(start) else s
+    print(bash_help(dev_help, cols, lines, script, *args))
+
+bash_cmt = ": '"
+is_cmt_end  = lambda l: l.rstrip().endswith("'")
+is_cmt_start= lambda l: l.lstrip().startswith(bash_cmt)
+
+def clean(s, head_sub, bash=True):
+    s = s.strip()
+    if bash: # w/o the : '...'
+        s = s[len(bash_cmt):] if s.startswith(bash_cmt) else s
         s = s[:-1] if s.endswith("'") else s
-        s = (('\n' + s).replace('\n#', '\n%s#' % head_sub))[1:]
-        return s
+    s = (('\n' + s).replace('\n#', '\n%s#' % head_sub))[1:]
+    return s
 
-    def render_func(m, single_func_doc):
-        fn = m.keys()[0]
-        hf, hs = ('# `Function` **%s**', '##') if single_func_doc else (
-                  '### %s', '###')
-        nr, pre, post, code = m.values()[0]
-        md = [hf % fn]
-        pre and md.append(clean('\n'.join(pre), hs))
-        post and md.append(clean('\n'.join(post), hs))
-        if code:
-            code = '\n'.join(code)
-            if post or pre:
-                md.append('')
-            md.append(code)
-            md.extend(['---', ''])
-        md = '\n'.join(md)
-        return md
-
-    fm = {}
-    for i in range(len(l)):
-        if is_func(l[i]):
-            fn = (l[i] + ' ').split(' ', 2)[1]
-            funcs.append({fn: [i, [], [], []]})
-            fm[fn] = len(funcs) - 1
-
-    if not '-h' in args[0]:
-        match = args[0]
-        f = []
-        for m in funcs:
-            if match in m.keys()[0]:
-                f.append(m)
-        if f:
-            funcs = f
-            single_func_doc = True
+def render_func(m, single_func_doc, bash=True):
+    '''
+    markdown of a function {name: [line nr, pre, post, code]}. pre, post:
+    doc lines, of bash (: '...') or else plain
+    '''
+    fn = list(m)[0]
+    hf, hs = ('# `Function` **%s**', '##') if single_func_doc else (
+              '### %s', '###')
+    nr, pre, post, code = m[fn]
+    md = [hf % fn]
+    pre and md.append(clean('\n'.join(pre), hs, bash))
+    post and md.append(clean('\n'.join(post), hs, bash))
+    if code:
+        code = '\n'.join(code)
+        if post or pre:
+            md.append('')
+        md.append(code)
+        md.extend(['---', ''])
+    md = '\n'.join(md)
+    return md
+
+def bash_funcs(l):
+    'the functions of a script with lines l: [{name: [line nr, [], [], []]}]'
+    return [{(l[i] + ' ').split(' ', 2)[1]: [i, [], [], []]}
+            for i in range(len(l)) if l[i].startswith('function ')]
 
+def bash_func_docs(l, funcs, dev_help):
+    'adds the doc lines before and after (and the code, for dev_help)'
     for m in funcs:
-        nr, pre, post, code = m.values()[0]
+        nr, pre, post, code = list(m.values())[0]
         # pre:
         if is_cmt_end(l[nr-1]):
             i = nr
@@ -588,7 +2560,7 @@ def format_bash(dev_help, cols, lines, script, *args):
             while True:
                 i += 1
                 post.append(l[i][4:])
-                if is_cmt_end(l[i]) and not l[i].strip() == start:
+                if is_cmt_end(l[i]) and not l[i].strip() == bash_cmt:
                     break
                 if l[i+1].rstrip().endswith('}'):
                     post = []; i = nr # err
@@ -600,52 +2572,228 @@ def format_bash(dev_help, cols, lines, script, *args):
                     break
                 code.append(l[i])
                 i += 1
+    return funcs
 
-    Facts.indent = 0
-    if single_func_doc:
-        for m in funcs:
-            md = render_func(m, single_func_doc)
-            main(md, term_width=cols)
-            print
-        return
+def bash_help(dev_help, cols, lines, script, *args):
+    'the help format_bash prints, rendered'
+    dev_help = True if str(dev_help) in ('True', 'true', '1') else False
+    funcs, single_func_doc = match_funcs(bash_funcs(lines), args[0])
+    bash_func_docs(lines, funcs, dev_help)
+    # the full doc. convention is to call with make_doc arg:
+    full = None if single_func_doc else os.popen(
+            script.split(' ')[0] + ' make_doc').read()
+    return funcs_help(funcs, single_func_doc, full, cols, dev_help)
+
+def match_funcs(funcs, arg):
+    'the funcs with arg in their name and True, else all (e.g. -h) and False'
+    if not '-h' in arg:
+        f = [m for m in funcs if arg in list(m)[0]]
+        if f:
+            return f, True
+    return funcs, False
 
-    # now the full doc. convention is to call with make_doc arg:
-    Facts.no_print = True
-    Facts.header_numbering = 10
-    Facts.header_numb_level_min = 2
-    Facts.header_numb_level_max = 2
+def funcs_help(funcs, single_func_doc, full, cols, dev_help, bash=True):
+    '''
+    Rendered help: the docs of the funcs (see render_func) - within the full
+    doc when not single_func_doc, at "<auto_command_doc>"
+    '''
+    kw = {'term_width': cols, 'no_print': True}
+    if single_func_doc:
+        return ''.join([render_or_clear(render_func(m, single_func_doc, bash),
+                                        **kw) + '\n\n' for m in funcs])[:-1]
 
-    full = os.popen(script.split(' ')[0] + ' make_doc').read()
+    dflt = {'header_numbering': 10, 'header_numb_level_min': 2,
+            'header_numb_level_max': 2}
     acd = '<auto_command_doc>'
     full = full.replace(acd, '## Commands\n\n' + acd)
-    md = main(full, term_width=cols)[0]
+    md = render_or_clear(full, defaults=dflt, **kw)
 
-    Facts.header_numbering = -1
     rfuncs, sep = '', '\n\n'
     if dev_help:
         sep = ''
     for m in funcs:
-        rfuncs = rfuncs + sep + render_func(m, single_func_doc)
-    mdf = main(rfuncs, term_width=cols)[0]
-    print(md.replace(acd, mdf))
-
+        rfuncs = rfuncs + sep + render_func(m, single_func_doc, bash)
+    dflt['header_numbering'] = -1
+    mdf = render_or_clear(rfuncs, defaults=dflt, **kw)
+    return md.replace(acd, mdf)
 
+def python_funcs(tree, lines, dev_help):
+    '''
+    The documented functions, classes and methods of a module (ast tree) as
+    bash_funcs, the docstring as post. With dev_help all, with their code.
+    '''
+    import ast
+    fdef = (ast.FunctionDef, getattr(ast, 'AsyncFunctionDef', ast.FunctionDef))
+    funcs = []
+    def add(node, name):
+        doc = ast.get_docstring(node)
+        if not dev_help and (not doc or name.split('.')[-1].startswith('_')):
+            return
+        nr, code = node.lineno - 1, []
+        if dev_help and getattr(node, 'end_lineno', None): # py >= 3.8
+            code = ['    ' + l[node.col_offset:]
+                    for l in lines[nr:node.end_lineno]]
+        funcs.append({name: [nr, [], doc.splitlines() if doc else [], code]})
+    for node in tree.body:
+        if isinstance(node, fdef):
+            add(node, node.name)
+        elif isinstance(node, ast.ClassDef):
+            add(node, node.name)
+            for n in node.body:
+                if isinstance(n, fdef):
+                    add(n, '%s.%s' % (node.name, n.name))
+    return funcs
+
+def python_help(dev_help, cols, lines, script, *args):
+    '''
+    Help of a python module, from its docstrings, as bash_help: module doc
+    plus those of functions, classes and methods. Via ast, w/o import.
+    '''
+    import ast
+    dev_help = True if str(dev_help) in ('True', 'true', '1') else False
+    try:
+        tree = ast.parse('\n'.join(lines) + '\n', script)
+    except SyntaxError as ex:
+        raise Exception('Could not parse %s: %s' % (script, ex))
+    funcs, single_func_doc = match_funcs(python_funcs(tree, lines, dev_help),
+                                         args[0])
+    full = ast.get_docstring(tree) or '# %s' % os.path.basename(script)
+    if not '<auto_command_doc>' in full:
+        full += '\n\n<auto_command_doc>'
+    return funcs_help(funcs, single_func_doc, full, cols, dev_help, False)
 
 
 def format_file(dev_help, cols, fn, *args):
+    '''
+    mdvl -f: help of a bash script or python module. Cached on disk by path,
+    mtime and size of the script, width, dev_help and args: a hit neither
+    reads the script nor runs its make_doc.
+    '''
     if not os.path.exists(fn):
         raise Exception('Not found' + fn)
-    with open(fn) as fd:
-        lines = fd.read().splitlines()
-    if 'bash' in lines[0]:
-        format_bash(dev_help, cols, lines, fn, *args)
-    else:
+    f = Facts('\n', term_width=cols)
+    def render():
+        with open(fn) as fd:
+            lines = fd.read().splitlines()
+        if lines and 'bash' in lines[0]:
+            return bash_help(dev_help, cols, lines, fn, *args)
+        if fn.endswith('.py') or lines and 'python' in lines[0]:
+            return python_help(dev_help, cols, lines, fn, *args)
         raise Exception('Not supported format')
+    dev_help = str(dev_help) in ('True', 'true', '1')
+    print(disk_cached(file_key(fn, f, '-f', dev_help, args), f, render))
 
-if __name__ == '__main__':
-    import os, sys
-    if len(sys.argv) > 1 and sys.argv[1] == '-f':
-        format_file(*sys.argv[2:])
+# mdvl -f --index DIR [--word] QUERY: the functions of all bash scripts below
+# DIR, from an index beside the disk cache, refreshed per script (by mtime
+# and size) - only changed scripts are read again.
+def script_funcs(fn):
+    '''
+    the functions of a bash script: [[name, line nr, pre, post, words]],
+    words: the lower case words of name and docs, as " w1 w2 ", for search
+    '''
+    import io
+    with io.open(fn, encoding='utf-8', errors='replace') as fd:
+        if not 'bash' in fd.readline():
+            return []
+        fd.seek(0)
+        l = fd.read().splitlines()
+    try:
+        funcs = bash_func_docs(l, bash_funcs(l), False)
+    except IndexError: # not following the conventions
+        return []
+    res = []
+    for m in funcs:
+        fn, (nr, pre, post, code) = list(m.items())[0]
+        ws = rx('\\w+').findall('\n'.join([fn] + pre + post).lower())
+        res.append([fn, nr, pre, post, ' %s ' % ' '.join(sorted(
+            dict.fromkeys(ws)))])
+    return res
+
+def func_index(d, **kw):
+    '''
+    {script path: [mtime, size, script_funcs]} of the files below dir d.
+    Stored in the cache dir (marshal, fast to load), w/o disk cache it is
+    built each time.
+    '''
+    import marshal, hashlib
+    f = Facts('\n', **kw)
+    d = os.path.abspath(d)
+    cfn = os.path.join(cache_dir(), hashlib.sha1(to_bytes(d)).hexdigest() +
+                       '.fidx')
+    key = repr((__version__, marshal.version))
+    old = {}
+    if f.disk_cache_bytes > 0 and os.path.exists(cfn):
+        with open(cfn, 'rb') as fd:
+            try:
+                old = marshal.loads(fd.read())
+            except Exception: # partially written, other python
+                pass
+        old = old.get(key, {}) if isinstance(old, dict) else {}
+    idx, changed = {}, False
+    for root, dirs, fns in os.walk(d):
+        dirs[:] = [n for n in dirs if not n.startswith('.')]
+        for fn in fns:
+            fn = os.path.join(root, fn)
+            try:
+                st = os.stat(fn)
+                e = old.get(fn)
+                if not e or e[:2] != [st.st_mtime, st.st_size]:
+                    e, changed = [st.st_mtime, st.st_size, script_funcs(fn)
+                                  ], True
+            except (IOError, OSError): # gone, not readable
+                continue
+            idx[fn] = e
+    if f.disk_cache_bytes <= 0 or not (changed or len(idx) < len(old)):
+        return idx
+    try:
+        if not os.path.exists(cache_dir()):
+            os.makedirs(cache_dir())
+        tmp = tmp_name(cfn)
+        with open(tmp, 'wb') as fd:
+            marshal.dump({key: idx}, fd)
+        os.rename(tmp, cfn)
+        evict(cache_dir(), f.disk_cache_bytes)
+    except (IOError, OSError) as ex: # cache is optional
+        if debug:
+            print('cache error: %s' % ex)
+    return idx
+
+def find_funcs(idx, q, words=False):
+    '''
+    Functions of a func_index with q in their name - or, with words, having
+    all words of q in their name or doc lines. [(path, name, nr, pre, post)]
+    '''
+    if words:
+        ws = [' %s ' % w for w in rx('\\w+').findall(q.lower())]
+        have = lambda e: not [w for w in ws if not w in e[4]]
     else:
-        sys_main()
+        have = lambda e: q in e[0]
+    return [(fn, ) + tuple(e[:4]) for fn in sorted(idx)
+            for e in idx[fn][2] if have(e)]
+
+def func_help(d, q, words=False, **kw):
+    'the rendered docs of the functions below dir d, found by find_funcs'
+    found, md, last = find_funcs(func_index(d, **kw), q, words), [], None
+    for fn, name, nr, pre, post in found:
+        if fn != last:
+            md.append('## %s' % os.path.relpath(fn, d))
+            last = fn
+        md.extend([render_func({name: [nr, pre, post, []]}, False), '',
+                   '*line %s*' % (nr + 1), ''])
+    if not md:
+        return
+    kw = dict(kw, no_print=True, defaults={'header_numbering': -1})
+    return render_or_clear('\n'.join(md), **kw)
+
+def func_search(argv, cols):
+    'mdvl -f --index DIR [--word] QUERY'
+    words = '--word' in argv
+    argv = [a for a in argv if a != '--word']
+    if len(argv) != 2 or not os.path.isdir(argv[0]):
+        return print('usage: ' + func_search.__doc__)
+    out = func_help(argv[0], argv[1], words, term_width=cols)
+    print('no function matching %s' % argv[1] if out is None else out)
+
+if __name__ == '__main__':
+    sys_main()
 
@@ -56,8 +56,6 @@ setup(
 
         # Specify the Python versions you support here. In particular, ensure
         # that you indicate whether you support Python 2, Python 3 or both.
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
         'Programming Language :: Python :: 3.5',
         'Programming Language :: Python :: 3.6',
@@ -66,6 +64,7 @@ setup(
     keywords=['markdown', 'markup', 'terminal', 'hilighting', 'syntax', 'source code'],
 
     py_modules=['mdvl'],
+    python_requires='>=3.5',
     zip_safe=False,
     entry_points={
         'console_scripts': [ 'mdvl=mdvl:sys_main' ],
@@ -0,0 +1,774 @@
+#!/usr/bin/env python -tt
+'''
+Benchmarks. Not run by the unittests, call directly:
+
+    ./bench_mdvl.py [name of bench function, w/o "bench_"]...
+
+Each bench prints its timings and fails (exit != 0) when a budget is exceeded.
+
+bench_corpus compares against stored baselines (bench_baseline.json), to
+record them after an intended change: export record=1, then run it.
+'''
+
+import sys, os, time, random, contextlib, tempfile, shutil
+pth = os.path.abspath(__file__).rsplit('/', 2)[0]
+sys.path.insert(0, pth)
+import mdvl
+
+
+def clock(func, *a, **kw):
+    ''' best of 3 wall time of func(*a, **kw) '''
+    best = None
+    for i in range(3):
+        t0 = time.time()
+        func(*a, **kw)
+        dt = time.time() - t0
+        best = dt if best is None else min(best, dt)
+    return best
+
+
+@contextlib.contextmanager
+def cache_home():
+    ''' a temp dir as XDG_CACHE_HOME (for the disk cache), removed after '''
+    d = tempfile.mkdtemp()
+    old, os.environ['XDG_CACHE_HOME'] = os.environ.get('XDG_CACHE_HOME'), d
+    try:
+        yield d
+    finally:
+        shutil.rmtree(d)
+        if old is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = old
+
+
+def check_linear(name, func, make, n, steps=4, tolerance=3):
+    '''
+    Times func(make(n * 2**k)) for k in range(steps) and fails if the time
+    grows by more than tolerance times the input growth.
+    '''
+    ts = []
+    for k in range(steps):
+        arg = make(n * 2 ** k)
+        ts.append(clock(func, arg))
+        print('%-30s n=%-8s %.4fs' % (name, n * 2 ** k, ts[-1]))
+    growth = ts[-1] / max(ts[0], 1e-6)
+    budget = tolerance * 2 ** (steps - 1)
+    assert growth < budget, '%s: superlinear, time grew %.1f times (max %s)' % (
+            name, growth, budget)
+
+
+def sample_doc(n, seed=1):
+    ''' n lines of typical mdvl input '''
+    r = random.Random(seed)
+    words = ('foo', 'bar', '*it*', '**em**', '`code`', 'baz', 'x' * 12)
+    para = lambda: ' '.join([r.choice(words) for i in range(r.randint(1, 30))])
+    kinds = (lambda: '# Header', lambda: '- ' + para(), lambda: '',
+             lambda: '> ' + para(), para, para, lambda: '    code')
+    return '\n'.join(['# Doc'] + [r.choice(kinds)() for i in range(n)])
+
+
+# ----------------------------------------------------------------- Benches
+apos = chr(96) * 3
+adversarial_fences = {
+        # openers which never close:
+        'unclosed' : lambda n: (apos + 'a\n' + 'x\n') * n,
+        # almost closing fences:
+        'near_close': lambda n: apos + 'a\n' + ('x\n' + apos[:2] + '\n') * n,
+        # backtick runs everywhere:
+        'backticks' : lambda n: ('`' * 7 + ' x ' + apos + 'y\n') * n,
+        # mixed fence chars and lengths:
+        'mixed'     : lambda n: ('~~~~\n' + apos + '\n~~~\n') * n,
+}
+
+def bench_fences():
+    ''' fence detection must stay linear on adversarial input '''
+    ref = lambda c: '\x02'
+    for k, make in sorted(adversarial_fences.items()):
+        check_linear('fences ' + k, lambda md: list(mdvl.extract_fences(
+            md.splitlines(), ref)), make, 2000)
+    check_linear('render unclosed fences', lambda md: mdvl.main(
+        md, no_print=True), adversarial_fences['unclosed'], 2000)
+
+
+def bench_alloc(max_ratio=6):
+    ''' peak memory while rendering, relative to the output size '''
+    import tracemalloc
+    md = sample_doc(20000)
+    for kw in {}, {'indent': 2, 'rindent': 2}:
+        tracemalloc.start()
+        res = mdvl.main(md, no_print=True, **kw)[0]
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        ratio = peak / float(len(res))
+        print('%-30s peak %.1fMB, %.2f times the output' % (
+            'alloc %s' % kw, peak / 1e6, ratio))
+        # was 7.2 with the document wide post processing passes:
+        assert ratio < max_ratio, 'peak memory: %.2f > %s' % (ratio, max_ratio)
+
+
+def bench_overhead(min_speedup=1.8):
+    ''' per call overhead for small snippets: main vs. a reused Renderer '''
+    md, n = '# Help\nsome *text*, `code`\n- a list', 2000
+    r = mdvl.Renderer(no_print=True)
+    t_main = clock(lambda: [mdvl.main(md, no_print=True) for i in range(n)])
+    t_r = clock(lambda: r.render_many([md] * n))
+    print('%-30s %.1fus per call' % ('main', t_main / n * 1e6))
+    print('%-30s %.1fus per call' % ('Renderer.render_many', t_r / n * 1e6))
+    assert t_main / t_r > min_speedup, 'Renderer speedup only %.1f' % (
+            t_main / t_r)
+
+
+def bench_profile(max_ratio=1.15, rounds=5):
+    '''
+    _render w/o profiling vs. the bare pipeline it runs, same source lines
+    and Facts, i.e. what the switch costs; profiling costs, shown
+    '''
+    md = sample_doc(5000)
+    src = md.splitlines()
+    f, on, mem = [mdvl.Facts(md, no_print=True, profile=p)
+                  for p in ('', 'True', 'mem')]
+    run = lambda f: lambda: ''.join(mdvl._render(src, f))
+    bare = lambda: ''.join(
+        mdvl._layout(mdvl._parse(mdvl.strip_lines(src), f), f))
+    # interleaved, best of rounds * 3 each, so load changes hit both alike:
+    t_bare, t_off = [min(t) for t in zip(*[(clock(bare), clock(run(f)))
+                                           for i in range(rounds)])]
+    t_on, t_mem = clock(run(on)), clock(run(mem))
+    for k, t in (('bare pipeline', t_bare), ('profile off', t_off),
+                 ('profile on', t_on), ('profile mem', t_mem)):
+        print('%-30s %.1fms' % (k, t * 1000))
+    assert t_off / t_bare < max_ratio, 'profiling switch costs %.2f' % (
+            t_off / t_bare)
+
+
+def bench_cache(max_ratio=0.1):
+    ''' disk cache hit vs. rendering, for a larger file '''
+    with cache_home() as d:
+        fn = d + '/doc.md'
+        with open(fn, 'w') as fd:
+            fd.write(sample_doc(5000))
+        t_read = clock(lambda: open(fn).read())
+        print('%-30s %.1fMB' % ('output', len(mdvl.render_file(fn)) / 1e6))
+        t_miss = clock(lambda: mdvl.render_file(fn, disk_cache_bytes=0))
+        t_hit = clock(lambda: mdvl.render_file(fn))
+        for k, t in (('source file read', t_read), ('render', t_miss),
+                     ('cache hit', t_hit)):
+            print('%-30s %.1fus' % (k, t * 1e6))
+        assert t_hit / t_miss < max_ratio, 'cache hit %.2f of render' % (
+                t_hit / t_miss)
+
+
+def bench_bash_help(n=300, max_ratio=0.7):
+    ''' mdvl -f of a bash script with n functions, cold vs. warm cache '''
+    import subprocess, tempfile, shutil
+    d = tempfile.mkdtemp()
+    env = dict(os.environ, XDG_CACHE_HOME=d)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    fn = d + '/tool.sh'
+    funcs = [": 'does f%s, %s'\nfunction f%s {\n    : 'param *x*'\n"
+             "    echo %s\n}\n" % (i, sample_doc(2, i).replace("'", ''), i, i)
+             for i in range(n)]
+    with open(fn, 'w') as fd:
+        fd.write("#!/bin/bash\nmd_doc () {\n    cat << 'EOF'\n# Tool\n\n%s"
+                 "\n\n<auto_command_doc>\nEOF\n}\n%s\n"
+                 'test "$1" == make_doc && md_doc\n' % (sample_doc(50),
+                                                        '\n'.join(funcs)))
+    os.chmod(fn, 0o755)
+    def run(*args, **kw):
+        p = subprocess.Popen((sys.executable, '-S', pth + '/mdvl.py', '-f') +
+                             args + (fn, '-h'), env=dict(env, **kw),
+                             stdout=subprocess.PIPE)
+        return p.communicate()[0]
+    try:
+        out = run('false', '80')
+        assert mdvl.to_bytes('f%s' % (n - 1)) in out
+        assert run('false', '80') == out # hit
+        for dev in 'false', 'true':
+            t_cold = clock(run, dev, '80', disk_cache_bytes='0')
+            t_warm = clock(run, dev, '80')
+            print('%-30s %.1fms' % ('mdvl -f %s, cold' % dev, t_cold * 1000))
+            print('%-30s %.1fms' % ('mdvl -f %s, warm' % dev, t_warm * 1000))
+            assert t_warm / t_cold < max_ratio, 'warm: %.2f of cold' % (
+                    t_warm / t_cold)
+    finally:
+        shutil.rmtree(d)
+
+
+def bench_python_help(n=1000, max_ratio=0.7):
+    '''
+    mdvl -f of a python module with n documented functions and slow
+    imports: cold (ast, no import, rendering) and warm (disk cache). Its
+    import time is shown for comparison
+    '''
+    import subprocess, tempfile, shutil
+    d = tempfile.mkdtemp()
+    env = dict(os.environ, XDG_CACHE_HOME=d, PYTHONPATH=d)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    with open(d + '/tool.py', 'w') as fd:
+        fd.write('"""\n%s\n"""\nimport time\ntime.sleep(0.5) # heavy imports'
+                 '\n\n%s' % (sample_doc(50).replace('"', ''), ''.join([
+                     'def f%s(x):\n    """%s"""\n    return x\n\n' % (
+                         i, sample_doc(3, i).replace('"', ''))
+                     for i in range(n)])))
+    def run(*args, **kw):
+        p = subprocess.Popen((sys.executable, '-S') + args,
+                             env=dict(env, **kw), stdout=subprocess.PIPE)
+        return p.communicate()[0]
+    f = (pth + '/mdvl.py', '-f', 'false', '80', d + '/tool.py', '-h')
+    try:
+        out = run(*f)
+        assert mdvl.to_bytes('f%s' % (n - 1)) in out and run(*f) == out
+        t_imp = clock(run, '-c', 'import tool')
+        t_cold = clock(run, *f, disk_cache_bytes='0')
+        t_warm = clock(run, *f)
+        for k, t in (('import tool', t_imp), ('mdvl -f tool.py, cold', t_cold),
+                     ('mdvl -f tool.py, warm', t_warm)):
+            print('%-30s %.1fms' % (k, t * 1000))
+        assert t_warm / t_cold < max_ratio, 'warm: %.2f of cold' % (
+                t_warm / t_cold)
+    finally:
+        shutil.rmtree(d)
+
+
+def bench_func_index(n=300, funcs=20, max_ratio=0.2):
+    '''
+    mdvl -f --index: search in n scripts, index built vs. warm, plus one
+    script changed
+    '''
+    with cache_home() as d:
+        src = d + '/src'
+        os.makedirs(src)
+        def write(i, v=''):
+            with open('%s/tool%s.sh' % (src, i), 'w') as fd:
+                fd.write('#!/bin/bash\n' + ''.join([
+                    ": 'does %s %s'\nfunction t%s_f%s%s {\n"
+                    "    : 'param *x*'\n    echo\n}\n" % (
+                        sample_doc(1, j).replace("'", ''), j, i, j, v)
+                    for j in range(funcs)]))
+        [write(i) for i in range(n)]
+        q = 't%s_f%s' % (n - 1, funcs - 1)
+        search = lambda **kw: mdvl.func_help(src, q, **kw)
+        assert q in search()
+        t_cold = clock(search, disk_cache_bytes=0)
+        t_warm = clock(search)
+        t_words = clock(search, words=True)
+        def change():
+            write(0, str(time.time()).replace('.', ''))
+            search()
+        t_change = clock(change)
+        for k, t in (('index built', t_cold), ('warm', t_warm),
+                     ('warm, word search', t_words),
+                     ('one script changed', t_change)):
+            print('%-30s %.1fms' % (k, t * 1000))
+        assert t_warm / t_cold < max_ratio, 'warm search: %.2f of cold' % (
+                t_warm / t_cold)
+
+
+def bench_startup(max_import_ms=8, max_help_ratio=2.5):
+    '''
+    cold import (python -X importtime) and end to end mdvl -h, relative to
+    the bare interpreter. Heavy modules must not be imported at startup.
+    '''
+    import subprocess
+    env = dict(os.environ, PYTHONPATH=pth)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    def run(*args):
+        p = subprocess.Popen((sys.executable, '-S') + args, env=env,
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE)
+        return p.communicate()[1].decode('utf-8')
+    run('-c', 'import mdvl') # .pyc
+    imps = [l.split('|') for l in run('-X', 'importtime', '-c', 'import mdvl'
+                                     ).splitlines() if '|' in l]
+    mods = dict([(m.strip(), c) for t, s, c, m in [[0] + i for i in imps]])
+    t_imp = int(mods['mdvl']) / 1000.
+    print('%-30s %.1fms' % ('import mdvl', t_imp))
+    heavy = [m for m in ('re', 'textwrap', 'hashlib', 'collections')
+             if m in mods]
+    assert not heavy, 'imported at startup: %s' % heavy
+    assert t_imp < max_import_ms, 'import time %.1fms' % t_imp
+    t_py = clock(run, '-c', 'pass')
+    t_help = clock(run, '-c', 'import mdvl; mdvl.sys_main()', '-h')
+    print('%-30s %.1fms' % ('python -S', t_py * 1000))
+    print('%-30s %.1fms' % ('mdvl -h', t_help * 1000))
+    assert t_help / t_py < max_help_ratio, 'mdvl -h: %.1f times python' % (
+            t_help / t_py)
+
+
+def bench_daemon(max_ratio=0.9):
+    ''' per call latency of mdvl <md>, with and w/o a running mdvl --serve '''
+    import subprocess, tempfile, shutil
+    d = tempfile.mkdtemp()
+    env = dict(os.environ, PYTHONPATH=pth, mdvl_socket=d + '/s')
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    srv = subprocess.Popen([sys.executable, pth + '/mdvl.py', '--serve'],
+                           stdout=subprocess.PIPE, env=env)
+    # as the mdvl console script does:
+    md, cli = sample_doc(30, seed=2), 'import mdvl; mdvl.sys_main()'
+    def run(**kw):
+        subprocess.Popen([sys.executable, '-S', '-c', cli, md],
+                         env=dict(env, **kw), stdin=subprocess.DEVNULL,
+                         stdout=subprocess.DEVNULL).wait()
+    try:
+        srv.stdout.readline() # serving
+        t_local = clock(run, mdvl_socket=d + '/none')
+        t_daemon = clock(run)
+    finally:
+        srv.terminate()
+        srv.wait()
+        shutil.rmtree(d)
+    print('%-30s %.1fms' % ('mdvl <md>', t_local * 1000))
+    print('%-30s %.1fms' % ('mdvl <md>, daemon', t_daemon * 1000))
+    assert t_daemon / t_local < max_ratio, 'daemon: %.2f of local' % (
+            t_daemon / t_local)
+
+
+def bench_batch(n=400, min_speedup=0.6):
+    '''
+    render_files of a docs tree, in process vs. over all cpus. The speedup
+    must be at least min_speedup times the cpu count.
+    '''
+    import tempfile, shutil
+    d = tempfile.mkdtemp()
+    cpus = os.cpu_count()
+    try:
+        for i in range(n):
+            sd = '%s/src/%s' % (d, i % 10)
+            if not os.path.exists(sd):
+                os.makedirs(sd)
+            with open('%s/%s.md' % (sd, i), 'w') as fd:
+                fd.write(sample_doc(100, seed=i))
+        ts = {}
+        for w in sorted(set((1, cpus))):
+            shutil.rmtree(d + '/out', True)
+            r = mdvl.render_files(d + '/src', d + '/out', w)
+            ts[w] = r['secs']
+            print('%-30s %.1f files/s, %.2f MB/s' % ('workers: %s' % w,
+                  r['files'] / r['secs'], r['bytes'] / r['secs'] / 1e6))
+        r = mdvl.render_files(d + '/src', d + '/out')
+        print('%-30s %.3fs' % ('all unchanged', r['secs']))
+        assert r['skipped'] == n
+    finally:
+        shutil.rmtree(d)
+    if cpus > 1:
+        assert ts[1] / ts[cpus] > min_speedup * cpus, 'speedup %.1f' % (
+                ts[1] / ts[cpus])
+
+
+def bench_layout(max_ratio=0.95):
+    '''
+    rendering at several widths: main each time vs. parse once, layout.
+    Wrapping (mdvl.wrap) is most of the layout time.
+    '''
+    md, widths = sample_doc(5000), (40, 60, 80, 120)
+    t_main = clock(lambda: [mdvl.main(md, no_print=True, term_width=w)
+                            for w in widths])
+    tree = mdvl.parse(md)
+    t_parse = clock(mdvl.parse, md)
+    t_layout = clock(lambda: [mdvl.layout(tree, term_width=w)
+                              for w in widths])
+    print('%-30s %.3fs' % ('main, %s widths' % len(widths), t_main))
+    print('%-30s %.3fs' % ('parse', t_parse))
+    print('%-30s %.3fs' % ('layout, %s widths' % len(widths), t_layout))
+    assert t_layout / t_main < max_ratio, 'layout %.2f of main' % (
+            t_layout / t_main)
+
+
+def bench_update(max_ratio=0.1):
+    '''
+    Renderer.update after edits in a 10k lines doc vs. rendering it all.
+    Time must depend on the size of the change, not of the document - up to
+    a linear scan (splitting and hashing of the segments).
+    '''
+    md = sample_doc(10000).splitlines()
+    r = mdvl.Renderer(no_print=True)
+    t_full = clock(mdvl.main, '\n'.join(md), no_print=True)
+    r.update('\n'.join(md))
+    print('%-30s %.3fs' % ('main', t_full))
+    ts = {}
+    for n in 1, 10, 100:
+        def edit():
+            for i in range(0, n * 20, 20):
+                md[5000 + i] += ' edited'
+            return r.update('\n'.join(md))
+        ts[n] = clock(edit)
+        print('%-30s %.4fs' % ('update, %s lines edited' % n, ts[n]))
+    assert ts[1] / t_full < max_ratio, 'update %.2f of main' % (
+            ts[1] / t_full)
+    assert ts[100] > 1.3 * ts[1], 'no dependency on the change size'
+
+
+def bench_watch(max_ratio=0.05):
+    '''
+    mdvl --watch: bytes written to the terminal and time, per edit of one
+    line, for a 200 x 60 screen. Full repaint (clear, print all) vs. diff.
+    '''
+    md = sample_doc(2000).splitlines()
+    r = mdvl.Renderer(no_print=True, term_width=200)
+    old = mdvl.screen_lines(r.update('\n'.join(md)))[:60]
+    md[20] += ' edited'
+    t = clock(lambda: mdvl.repaint(old, mdvl.screen_lines(
+        r.update('\n'.join(md)))[:60]))
+    new = mdvl.screen_lines(r.update('\n'.join(md)))[:60]
+    full = len('\x1b[2J' + mdvl.repaint([], new))
+    diff = len(mdvl.repaint(old, new))
+    print('%-30s %s bytes' % ('full repaint', full))
+    print('%-30s %s bytes, %.1fms' % ('diff repaint', diff, t * 1000))
+    assert 0 < diff < max_ratio * full, 'diff repaint: %s bytes' % diff
+
+
+def bench_page(max_ratio=0.1):
+    '''
+    mdvl --page: time to the first screen and for jumps in a 100k lines doc,
+    vs. rendering it all (as for mdvl big.md | less -R).
+    '''
+    md = sample_doc(100000)
+    t_full = clock(mdvl.main, md, no_print=True)
+    def first():
+        p = mdvl.Pager(md)
+        return p.view((0, 0), 50)
+    t_first = clock(first)
+    p = mdvl.Pager(md)
+    t_jump = clock(lambda: p.view(p.find_line(90000), 50))
+    t_head = clock(lambda: p.view(p.find_header('Header', (8000, 0)), 50))
+    for k, t in (('main', t_full), ('pager, first screen', t_first),
+                 ('jump to line 90000', t_jump), ('jump to a header', t_head)):
+        print('%-30s %.4fs' % (k, t))
+    print('%-30s %s of %s' % ('segments rendered', len(p.out), len(p.index)))
+    assert t_first / t_full < max_ratio, 'first screen %.2f of main' % (
+            t_first / t_full)
+
+
+def bench_sections(max_ratio=0.01):
+    '''
+    mdvl FILE --section: one section of a 200k lines handbook, index build
+    (first call) and with the sidecar, vs. rendering the whole file.
+    '''
+    with cache_home() as d:
+        fn = d + '/handbook.md'
+        with open(fn, 'w') as fd:
+            fd.write(sample_doc(200000))
+        t_full = clock(lambda: mdvl.main(open(fn).read(), no_print=True))
+        t0 = time.time()
+        idx = mdvl.section_index(fn)
+        t_index = time.time() - t0
+        nr = idx['heads'][len(idx['heads']) // 2][1]
+        t_sect = clock(mdvl.render_section, fn, nr)
+        t_toc = clock(mdvl.toc, fn)
+        print('%-30s %.1fMB, %s headers' % ('file', os.stat(fn).st_size / 1e6,
+                                          len(idx['heads'])))
+        for k, t in (('render all', t_full), ('index build', t_index),
+                     ('section %s, indexed' % nr, t_sect), ('toc', t_toc)):
+            print('%-30s %.4fs' % (k, t))
+        assert t_sect / t_full < max_ratio, 'section %.3f of all' % (
+                t_sect / t_full)
+
+
+def bench_head(n=30, max_ratio=3):
+    '''
+    max_lines (mdvl --head N): time for the first n lines of docs of
+    growing size must not grow with the document.
+    '''
+    ts = {}
+    for size in 1000, 100000:
+        md = sample_doc(size)
+        ts[size] = clock(mdvl.main, md, no_print=True, max_lines=n)
+        print('%-30s %.4fs' % ('%s of %s lines' % (n, size), ts[size]))
+    print('%-30s %.4fs' % ('all of %s lines' % size, clock(
+        mdvl.main, md, no_print=True)))
+    assert ts[100000] / ts[1000] < max_ratio, 'head grows with the doc'
+
+
+def bench_wrap(max_ratio=0.8, max_ratio_markup=1.5):
+    '''
+    mdvl.wrap vs. textwrap.fill, on long paragraphs. With markup wrap pairs
+    the markers first (to not count them), fill simply counts them as text.
+    '''
+    from textwrap import fill
+    r = random.Random(0)
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet,', 'consectetur',
+             'well-known', 'a', 'elit.']
+    plain = ' '.join(r.choice(words) for i in range(20000))
+    marked = ' '.join(r.choice(words + ['*it*', '**em**', '`code`'])
+                      for i in range(20000))
+    for k, s, mx in ('plain', plain, max_ratio), (
+            'markup', marked, max_ratio_markup):
+        t_fill = clock(fill, s, subsequent_indent='  ', width=80)
+        t_wrap = clock(mdvl.wrap, s, 80, '  ')
+        print('%-30s %.4fs' % ('textwrap.fill, %s' % k, t_fill))
+        print('%-30s %.4fs' % ('wrap, %s' % k, t_wrap))
+        assert t_wrap / t_fill < mx, 'wrap %.2f of fill, %s' % (
+                t_wrap / t_fill, k)
+
+
+# ----------------------------------------------------------------- Corpus
+# Seeded generators for the shapes which stress mdvl, each make(n, seed)
+# returns a doc of about n lines.
+markup_words = ('foo', 'bar', '*it*', '**em**', '`code`', 'baz', 'x' * 12,
+                'well-known', 'lorem', 'ipsum', 'dolor')
+
+
+def para(r, n_words):
+    return ' '.join([r.choice(markup_words) for i in range(n_words)])
+
+
+def gen(n, seed, block):
+    ''' joins block(r) (a list of lines) until n lines '''
+    r, lines = random.Random(seed), []
+    while len(lines) < n:
+        lines.extend(block(r))
+    return '\n'.join(lines[:n])
+
+
+def readmes(n, seed):
+    ''' the READMEs of this repo, repeated: real world input, offline '''
+    md = ''
+    for fn in ('README.md', 'tests/readme.md'):
+        with open('%s/%s' % (pth, fn)) as fd:
+            md += fd.read() + '\n'
+    lines = md.splitlines()
+    return '\n'.join((lines * (n // len(lines) + 1))[:n])
+
+
+corpus = {
+    # one paragraph per source line, wrapped into many output lines:
+    'paragraphs': lambda n, seed: gen(n, seed, lambda r: [
+        para(r, r.randint(100, 400)), '']),
+    'fenced_code': lambda n, seed: gen(n, seed, lambda r: [
+        apos + 'python'] + ['x = %s  # *no* markup' % i
+                            for i in range(r.randint(1, 8))] + [apos, '']),
+    'indented_code': lambda n, seed: gen(n, seed, lambda r: [
+        para(r, 5), ''] + ['    code %s' % i
+                           for i in range(r.randint(1, 8))] + ['']),
+    'blockquotes': lambda n, seed: gen(n, seed, lambda r: [
+        '>' * r.randint(1, 12) + ' ' + para(r, r.randint(1, 40))
+        for i in range(r.randint(1, 10))] + ['']),
+    'lists': lambda n, seed: gen(n, seed, lambda r: [
+        '  ' * r.randint(0, 3) + r.choice('-*') + ' ' + para(
+            r, r.randint(1, 30)) for i in range(r.randint(5, 50))] + ['']),
+    'light_tables': lambda n, seed: gen(n, seed, lambda r: [
+        r.choice(('*%s* ', '-%s: ')) % ('key%s' % i) + para(
+            r, r.randint(1, 30)) for i in range(r.randint(5, 50))] + ['']),
+    # more lines than header_numbering, i.e. numbered:
+    'headers': lambda n, seed: gen(n, seed, lambda r: [
+        '#' * r.randint(1, 4) + ' Header ' + para(r, 2), para(r, 5)]),
+    'readmes': readmes,
+}
+
+
+def calibrate():
+    '''
+    Time of a fixed pure python workload (string ops as in rendering, few
+    allocations), to compare throughputs across machines and loads:
+    baselines are stored relative to it.
+    '''
+    def work():
+        s, d, n = 'lorem *ipsum* dolor `sit` amet, well-known', {}, 0
+        for i in range(60000):
+            w = s.split(' ')
+            d[w[i % 6]] = d.get(w[i % 6], 0) + len(' '.join(w[1:4]))
+            n += s.find('`', i % 20) + s.count('o')
+        return n, d
+    return clock(work)
+
+
+def bench_corpus(n=5000, threshold=None, shapes=None, tries=3):
+    '''
+    mdvl.render on each corpus shape: throughput (MB/s, lines/s) and peak
+    memory (relative to the output). Fails when throughput drops or memory
+    grows by more than threshold ($bench_threshold, default 0.25) against
+    bench_baseline.json. Slower shapes are measured again, up to tries
+    times: a regression stays, noise (e.g. of shared cpus) does not.
+    '''
+    import json, tracemalloc
+    if threshold is None:
+        threshold = float(os.environ.get('bench_threshold') or 0.25)
+    fn = pth + '/tests/bench_baseline.json'
+    base, record = {}, os.environ.get('record')
+    if os.path.exists(fn) and not record:
+        with open(fn) as fd:
+            base = json.load(fd)
+    print('%-16s %8s %10s %8s %8s %6s' % ('', 'MB/s', 'lines/s', 'peak MB',
+                                           'peak/out', 'speed'))
+    res, fails = {}, []
+    for k in shapes or sorted(corpus):
+        md = corpus[k](n, seed=1)
+        b = base.get('shapes', {}).get(k)
+        r = {'speed': 0}
+        for i in range(tries):
+            t_ref = calibrate() # right before, i.e. under the same load
+            t = clock(mdvl.render, md, 80, no_print=True)
+            if len(md) / t / 1e6 * t_ref > r['speed']:
+                r = {'mb_s': round(len(md) / t / 1e6, 3),
+                     'lines_s': int(n / t),
+                     'speed': round(len(md) / t / 1e6 * t_ref, 4)}
+            if not b or r['speed'] >= b['speed']:
+                break
+        tracemalloc.start()
+        out = mdvl.render(md, 80, no_print=True)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        res[k] = r
+        r['peak_ratio'] = round(peak / float(len(out)), 2)
+        print('%-16s %8.2f %10d %8.1f %8.2f %6.3f' % (
+            k, r['mb_s'], r['lines_s'], peak / 1e6, r['peak_ratio'],
+            r['speed']))
+        if not b:
+            continue
+        if r['speed'] < b['speed'] * (1 - threshold):
+            fails.append('%s: throughput %.0f%% of baseline' % (
+                k, 100 * r['speed'] / b['speed']))
+        if r['peak_ratio'] > b['peak_ratio'] * (1 + threshold):
+            fails.append('%s: peak memory %.0f%% of baseline' % (
+                k, 100 * r['peak_ratio'] / b['peak_ratio']))
+    if record:
+        base = {'n': n, 'shapes': res}
+        with open(fn, 'w') as fd:
+            fd.write(json.dumps(base, indent=1, sort_keys=True) + '\n')
+        print('recorded %s' % fn)
+    elif not base:
+        print('no baseline - to record one: export record=1, then run')
+    assert not fails, 'regressions:\n' + '\n'.join(fails)
+
+
+# ------------------------------------------------------ Engines, differential
+# engine='legacy' (the original _main) and the default engine must render
+# byte identical, but for these intended changes (the goldens showing them):
+engine_changes = {
+    'test_blocks': 'lines with markup are wrapped by visible width',
+    'test_light_table': 'lines with markup are wrapped by visible width',
+    'test_fences': 'fences as in CommonMark, not by a regex',
+    'test_inline': 'unbalanced markup stays literal',
+    'test_many_code_blocks': 'code placeholder 1 does not match 10',
+}
+engine_classes = ('paragraphs', 'light_tables', 'lists', 'blockquotes',
+                  'headers', 'fenced_code', 'indented_code', 'rules',
+                  'wrapped_markup', 'star_lists', 'code_first', 'many_code')
+# classes with intended changes, they must differ for some seeds:
+engine_class_changes = {
+    'wrapped_markup': engine_changes['test_blocks'],
+    'star_lists': engine_changes['test_inline'], # stars of two items
+    'many_code': engine_changes['test_many_code_blocks'],
+}
+
+
+def engine_doc(seed, kind):
+    '''
+    (md, config), random but seeded, of an input class or 'mixed'. Only the
+    classes wrapped_markup, star_lists, code_first and many_code have markup
+    in wrapped text, "* " lists, code at the start, 10 or more code blocks.
+    'mixed' is w/o them. Never: headers w/o parent level.
+    '''
+    r = random.Random(seed)
+    kw = r.choice(({}, {'term_width': 40}, {'indent': 2, 'rindent': 3},
+                   {'header_numbering': 5, 'term_width': 60}, {'width': 50}))
+    ws = ('foo', 'bar', 'baz', 'lorem', 'ipsum', 'a', 'well-known', 'x' * 14)
+    wrapped = kind == 'wrapped_markup'
+    markup = wrapped or kind == 'light_tables' or r.random() < 0.5
+    if markup:
+        ws += ('*it*', '**em**', '`code`')
+    if markup and not wrapped:
+        kw = dict(kw, term_width=200, width=0)
+    words = lambda n, ws=ws: ' '.join([r.choice(ws) for i in range(n)])
+    para = lambda: words(r.randint(1, 30)) + r.choice(('', '', '  '))
+    if markup and not wrapped: # short lines with hard breaks, no wrapping
+        para = lambda: words(r.randint(1, 6)) + '  '
+    g = {'level': 0, 'code': 0}
+    def header():
+        g['level'] = r.randint(1, g['level'] + 1)
+        return ['#' * g['level'] + ' ' + words(r.randint(1, 5)), para(), '']
+    def fenced():
+        return [apos + r.choice(('py', 'sh'))] + [
+            words(4, [w for w in ws if not '`' in w])
+            for i in range(r.randint(1, 4))] + [apos]
+    def code(block):
+        g['code'] += 1
+        return block() if g['code'] < 10 or kind == 'many_code' else []
+    indented = lambda: ['    ' + words(4) for i in range(3)]
+    make = {
+        'paragraphs': lambda: [para() for i in range(r.randint(1, 6))],
+        'light_tables': lambda: [r.choice(('*%s* ', '**%s** ', '-%s: ')) % (
+            r.choice(ws[:5])) + para() for i in range(r.randint(1, 6))],
+        'lists': lambda: [r.choice(('', '  ')) + '- ' + para()
+                          for i in range(r.randint(1, 6))],
+        'blockquotes': lambda: ['>' * r.randint(1, 4) + ' ' + para()
+                                for i in range(r.randint(1, 4))],
+        'headers': header,
+        'fenced_code': lambda: code(fenced),
+        'indented_code': lambda: code(indented),
+        'rules': lambda: [r.choice(('---', '***', '___', '-----'))],
+        'wrapped_markup': lambda: [para() for i in range(r.randint(1, 6))],
+        'star_lists': lambda: [r.choice(('', '  ')) + '* ' + para()
+                               for i in range(r.randint(1, 6))],
+        'code_first': lambda: [para() for i in range(r.randint(1, 6))],
+        'many_code': lambda: code(r.choice((fenced, indented))),
+    }
+    kinds = [k for k in engine_classes[:8] if markup or k != 'light_tables'
+             ] if kind == 'mixed' else (kind,)
+    lines, n = [para(), ''], r.randint(5, 30)
+    if kind == 'code_first':
+        lines = r.choice((fenced, indented))() + ['']
+    elif kind == 'many_code':
+        n = 60
+    while len(lines) < n:
+        lines += make[r.choice(kinds)]() + ['']
+    return '\n'.join(lines), kw
+
+
+def golden_sources():
+    ''' (name, md, config) of the golden tests (test_mdvl.M) '''
+    sys.path.insert(0, pth + '/tests')
+    import test_mdvl
+    res = []
+    class M(test_mdvl.M):
+        def c(s, md, testcase, **kw):
+            res.append((testcase, test_mdvl.dedent(md), kw))
+    for k in sorted(dir(M)):
+        if k.startswith('test_'):
+            getattr(M(k), k)()
+    return res
+
+
+def engines_differ(md, kw):
+    ''' None or the two renderings, when the engines differ '''
+    a, b = [mdvl.main(md, no_print=True, debug=True, engine=e, **kw)[0]
+            for e in ('legacy', 'fast')]
+    return None if a == b else (a, b)
+
+
+def bench_engines(n=30):
+    '''
+    Differential run, engine legacy vs. fast: n seeded docs per input class
+    and the golden test sources must render byte identical (see
+    engine_changes). Prints the speed ratio per input class.
+    '''
+    for name, md, kw in golden_sources():
+        d = engines_differ(md, kw)
+        assert bool(d) == (name in engine_changes), '%s: %s' % (
+            name, 'differs' if d else 'identical, remove from engine_changes')
+    print('%-16s %10s %10s %8s' % ('', 'legacy', 'fast', 'ratio'))
+    for k in engine_classes + ('mixed',):
+        t, differ = {'legacy': 0, 'fast': 0}, 0
+        for seed in range(n):
+            md, kw = engine_doc(seed, k)
+            res = []
+            for e in 'legacy', 'fast':
+                t0 = time.time()
+                res.append(mdvl.main(md, no_print=True, debug=True, engine=e,
+                                     **kw)[0])
+                t[e] += time.time() - t0
+            differ += res[0] != res[1]
+            assert res[0] == res[1] or k in engine_class_changes, \
+                'engine_doc(%s, %r) %r:\n%r\n%r' % (seed, k, kw, *res)
+        assert differ or k not in engine_class_changes, \
+            '%s: identical, remove from engine_class_changes' % k
+        print('%-16s %9.1fms %9.1fms %8.2f' % (k, t['legacy'] * 1000,
+              t['fast'] * 1000, t['legacy'] / t['fast']))
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(k[6:] for k in dir() if
+                                   k.startswith('bench_'))
+    for name in names:
+        print('\n%s\n%s' % (name, '=' * len(name)))
+        globals()['bench_' + name]()
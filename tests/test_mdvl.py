@@ -1,7 +1,8 @@
 #!/usr/bin/env python -tt
+# coding: utf-8
 
 import unittest, sys, os
-import operator
+import operator, contextlib, tempfile, shutil
 import time
 pth = os.path.abspath(__file__).rsplit('/', 2)[0]
 sys.path.insert(0, pth)
@@ -20,6 +21,20 @@ def dedent(s):
     ind = len(md[1]) - len(md[1].lstrip())
     return '\n'.join([m[ind:] for m in md])
 
+@contextlib.contextmanager
+def cache_home():
+    'a temp dir as XDG_CACHE_HOME (i.e. for the disk cache), removed after'
+    d = tempfile.mkdtemp()
+    old, os.environ['XDG_CACHE_HOME'] = os.environ.get('XDG_CACHE_HOME'), d
+    try:
+        yield d
+    finally:
+        shutil.rmtree(d)
+        if old is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = old
+
 class F(unittest.TestCase):
     def test_gslti(s):
         gslti = mdvl.get_subseq_light_table_indent
@@ -41,6 +56,743 @@ class F(unittest.TestCase):
         assert gslti('**a b**: b ' ) == 5
 
 
+    def test_render_stream(s):
+        md = '\n'.join(['# H1', '', '- item *it*', '> quote', '',
+                        '```', 'code', '```', 'text  ', 'more text'] * 30)
+        exp = mdvl.main(md, no_print=True, indent=2)[0]
+        for lines in md.splitlines(True), md.splitlines(), [md]:
+            chunks = list(mdvl.render_stream(lines, indent=2))
+            assert len(chunks) > 1 or lines == [md]
+            assert ''.join(chunks) == exp
+        for md in 'single line', '':
+            exp = mdvl.main(md, no_print=True)[0]
+            assert ''.join(mdvl.render_stream([md])) == exp
+
+    def test_render_stream_incremental(s):
+        seen = []
+        def src():
+            for i in range(100):
+                seen.append(i)
+                yield 'paragraph %s\n' % i
+                yield '\n'
+        # w/o numbering, else the first header_numbering lines are buffered:
+        chunks = mdvl.render_stream(src(), header_numbering=-1)
+        assert 'paragraph 0' in next(chunks)
+        assert len(seen) < 5
+
+
+    def test_renderer(s):
+        docs = ['# H1\nfoo *it*', 'single *line*', '',
+                '- a list item which is long enough to be wrapped ' * 3]
+        for kw in {}, {'indent': 2, 'width': 30}:
+            r = mdvl.Renderer(no_print=True, **kw)
+            for i in range(2): # no state kept between renderings
+                res = r.render_many(docs)
+                assert res == [mdvl.main(md, no_print=True, **kw)[0]
+                               for md in docs]
+
+    def test_renderer_update(s):
+        md = ['# H1', 'text *it*', '', '> quote', '', '## H2', '', '```',
+              'code', '', '```', '', '    indented', '', '- list'] * 5
+        edits = ((3, '> changed'), (0, '# new H1'), (7, 'no fence'),
+                 (12, 'text'), (30, '### H3'), (40, ''), (1, ' '))
+        for kw in {}, {'header_numbering': 5, 'term_width': 30}:
+            r = mdvl.Renderer(no_print=True, **kw)
+            for nr, l in ((None, None),) + edits:
+                if nr is not None:
+                    md[nr] = l
+                exp = mdvl.main('\n'.join(md), no_print=True, **kw)[0]
+                assert r.update('\n'.join(md)) == exp
+            assert r.update('single line') == mdvl.main('single line',
+                                                        no_print=True)[0]
+
+    def test_max_lines(s):
+        md = '\n'.join(['# H%s\n\n```\ncode\n```\n\n> *line %s*' % (i, i)
+                        for i in range(200)])
+        for kw in {}, {'indent': 2, 'rindent': 1, 'header_numbering': 5}:
+            full = mdvl.main(md, no_print=True, **kw)[0]
+            ls = full.split('\n')
+            for n in 1, 7, 30:
+                out = mdvl.main(md, no_print=True, max_lines=n, **kw)[0]
+                assert out == '\n'.join(ls[:n + 1] + [ls[-1]])
+            for n in len(ls) - 2, len(ls) + 1: # all lines
+                assert mdvl.main(md, no_print=True, max_lines=n, **kw)[0
+                                 ] == full
+        # the source is read only as far as required:
+        read = []
+        def src():
+            for l in md.splitlines():
+                read.append(l)
+                yield l
+        out = ''.join(mdvl.render_stream(src(), max_lines=10))
+        assert out.count('\n') == 11 and len(read) < 80
+        # cli: usage, not a traceback, for a missing or bad number:
+        import io, contextlib
+        for argv in ['# H', '--head'], ['# H', '--head', 'x']:
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                mdvl.cli(argv, 40, False)
+            assert out.getvalue().startswith('usage: ')
+
+    def test_header_numbering_w_o_parent(s):
+        md = '## a\n# b\n### c'
+        out = mdvl.main(md, no_print=True, header_numbering=1)[0]
+        for nr in '0.1 a', '1 b', '1.0.1 c':
+            assert nr in out
+        shown = '\n'.join(mdvl.Pager(md, header_numbering=1).view((0, 0), 9))
+        for nr in '0.1 a', '1 b', '1.0.1 c':
+            assert nr in shown
+
+    def test_wrap(s):
+        from textwrap import fill
+        w = mdvl.wrap
+        for t in 'a well-known  word-splitting\tthing ' * 5, 'x' * 50:
+            for width, ind in (10, ''), (17, '>  '), (4, '      '):
+                assert w(t, width, ind) == fill(
+                        t, width, subsequent_indent=ind).replace(' \n', '\n')
+        # markup, escapes and code refs are not counted:
+        assert w('**aa** *bb* `cc` dd', 7) == '**aa** *bb*\n`cc` dd'
+        assert w('\x1b[1maa\x1b[0m bb \x020\x02', 5) == \
+                '\x1b[1maa\x1b[0m bb\n\x020\x02'
+        # unclosed ones are:
+        assert w('**aa bb', 5) == '**aa\nbb'
+        # wide and combining chars:
+        assert w(u'日本語 日本', 6, '> ') == u'日本語\n> 日本'
+        assert w(u'éé ab', 5) == u'éé ab'
+        assert w(u'日本語', 3) == u'日\n本\n語'
+        # rendered: no line wider than the terminal:
+        md = u'- **item** 日本語のテキスト, *more* text ' * 10
+        res = mdvl.main(md, no_print=True, term_width=30)[0]
+        for l in mdvl.rx(mdvl.sgr_re).sub('', res).splitlines():
+            assert sum([mdvl.char_width(c) for c in l]) <= 30
+
+    def test_profile(s):
+        md = '\n'.join(['# H1', '', '>> - quoted *item* ' * 9, '',
+                        '```', 'code', '```', '', '    indented', '', '---'])
+        exp = mdvl.main(md, no_print=True, term_width=40)[0]
+        r = mdvl.Renderer(no_print=True, term_width=40, profile=True)
+        assert r.render(md) == exp
+        st = r.stats
+        assert set(st['phases']) == set(['lines', 'fences', 'parse', 'wrap',
+                                         'inline', 'emit', 'code', 'layout'])
+        assert st['phases']['wrap']['calls'] == 1
+        c = st['counts']
+        assert (c['headers'], c['fenced_code'], c['indented_code'],
+                c['max_bq_depth'], c['wrapped']) == (1, 1, 1, 2, 1)
+        assert c['out_lines'] == exp.count('\n')
+        assert 'peak_kb' not in st['phases']['parse']
+        r = mdvl.Renderer(no_print=True, profile='mem')
+        r.render(md)
+        assert r.stats['phases']['parse']['peak_kb'] >= 0
+        assert mdvl.Renderer(no_print=True).render(md) and \
+                mdvl.main(md, no_print=True)[1].stats is None
+        os.environ['profile'] = 'mem' # not ours
+        try:
+            assert not mdvl.Facts(md).profile
+        finally:
+            del os.environ['profile']
+        # $mdvl_profile: JSON on stderr, also for streams:
+        import json, io
+        os.environ['mdvl_profile'], err = '1', sys.stderr
+        sys.stderr = io.StringIO()
+        try:
+            assert ''.join(mdvl.render_stream(md.splitlines())) == \
+                    mdvl.main(md, no_print=True)[0]
+            res = [json.loads(l) for l in sys.stderr.getvalue().splitlines()]
+        finally:
+            del os.environ['mdvl_profile']
+            sys.stderr = err
+        assert len(res) == 2 and res[0]['counts'] == res[1]['counts']
+
+    def test_engines(s):
+        from tests.bench_mdvl import engine_doc, engines_differ
+        for seed in range(5):
+            assert not engines_differ(*engine_doc(seed, 'mixed'))
+        md = '# H\n\n*key* text which is long enough to wrap\n- item'
+        exp = mdvl.main(md, no_print=True, engine='legacy', term_width=20)[0]
+        os.environ['mdvl_engine'] = 'legacy'
+        os.environ['engine'] = 'docker' # not ours
+        try:
+            r = mdvl.Renderer(no_print=True, term_width=20)
+            assert r.facts[False].engine == 'legacy'
+            assert r.render(md) == r.update(md) == exp
+        finally:
+            del os.environ['mdvl_engine'], os.environ['engine']
+        with s.assertRaises(Exception):
+            mdvl.main(md, engine='turbo')
+
+    def test_threads(s):
+        import threading, io, contextlib
+        from tests.bench_mdvl import engine_doc
+        docs = [engine_doc(seed, 'mixed')[0] for seed in range(8)]
+        docs += ['# single *line*', '# H\n\n## h\n\ntext ' * 30]
+        r = mdvl.Renderer(no_print=True, term_width=50, cache_size=5)
+        dflt = {'header_numbering': 1, 'header_numb_level_min': 2}
+        kws = [{}, {'term_width': 30, 'indent': 2}, {'cache_size': 3},
+               {'defaults': dflt}, {'H1': 124, 'width': 40},
+               {'engine': 'legacy'}]
+        jobs = [(md, i) for md in docs for i in range(len(kws) + 2)]
+        def run(job):
+            md, i = job
+            if i < len(kws):
+                return mdvl.main(md, no_print=True, **kws[i])[0]
+            return r.render(md) if i == len(kws) else r.update(md)
+        cfg = lambda c: [(k, v) for k, v in vars(c).items() if k[0] != '_']
+        cls = [cfg(c) for c in (mdvl.Facts, mdvl.Colors)]
+        os.environ['I'] = '130' # env color default, read at setup
+        sw = sys.getswitchinterval()
+        try:
+            exp = [run(j) for j in jobs]
+            res, out = {}, io.StringIO()
+            def worker(n):
+                for k in range(len(jobs)):
+                    k = (k * 7 + n) % len(jobs)
+                    res.setdefault(k, []).append(run(jobs[k]))
+            sys.setswitchinterval(1e-6)
+            with contextlib.redirect_stdout(out):
+                ts = [threading.Thread(target=worker, args=(n,))
+                      for n in range(8)]
+                [t.start() for t in ts]
+                [t.join() for t in ts]
+        finally:
+            sys.setswitchinterval(sw)
+            del os.environ['I']
+        assert '\x1b[1;38;5;130m' in exp[jobs.index((docs[-1], 0))] # H1
+        assert not out.getvalue()
+        assert cls == [cfg(c) for c in (mdvl.Facts, mdvl.Colors)]
+        for k, e in enumerate(exp):
+            assert res[k] == [e] * 8, jobs[k]
+
+    def test_errors(s):
+        import io, contextlib, tempfile, shutil
+        md = '*abc def\nmore text' # fails to render
+        def run(f, *a, **kw):
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                res = f(*a, **kw)
+            return res, out.getvalue()
+        # default: raised, nothing printed:
+        for f in mdvl.main, mdvl.Renderer(no_print=True).render:
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                with s.assertRaises(Exception):
+                    f(md, no_print=True) if f is mdvl.main else f(md)
+            assert out.getvalue() == ''
+        with s.assertRaises(Exception):
+            mdvl.render(md, 40)
+        assert run(mdvl.main, md, no_print=True, on_error='none') == (None, '')
+        assert mdvl.render(md, 40, on_error='none') is None
+        # as in the cli: clear text and error printed:
+        res, out = run(mdvl.main, md, no_print=True, on_error='print')
+        assert res is None and out.startswith(md) and 'md error' in out
+        assert mdvl.render_or_clear(md) == out[:-1]
+        d = tempfile.mkdtemp()
+        try:
+            fn = d + '/bad.md'
+            with open(fn, 'w') as fd:
+                fd.write(md)
+            assert run(mdvl.render_file, fn) == (None, '')
+            assert run(mdvl.cli, [fn], 40, False)[1] == out # cli: shown
+            lines = ['#!/bin/bash', ": '%s'" % md.split('\n')[0],
+                     'function foo {', '    : \'x\'', '}']
+            help = mdvl.bash_help('false', 40, lines, fn, 'foo')
+            assert 'foo' in help and 'md error' in help
+        finally:
+            shutil.rmtree(d)
+
+    def test_code_ph_in_source(s):
+        # the placeholder delimiter in the source itself:
+        for md in 'a \x02b\x02 c\n```\ncode\n```', 'a \x02 c\n```\ncode\n```':
+            res = mdvl.main(md, no_print=True)[0]
+            assert 'code' in res and md.split('\n')[0] in res
+
+    def test_get_cols(s):
+        os.environ['term_width'] = '42'
+        try:
+            assert mdvl.get_cols() == '42'
+        finally:
+            del os.environ['term_width']
+        assert int(mdvl.get_cols()) > 0
+
+    def test_layout(s):
+        md = '\n'.join(['# H1', '- item *it* ' * 5, '> quote ' * 20, '',
+                        '```py', 'code', '```', 'text  ', 'more text'] * 5)
+        kws = {}, {'term_width': 30}, {'indent': 4, 'width': 50}
+        exp = [mdvl.main(md, no_print=True, **dict({'indent': 1}, **kw))[0]
+               for kw in kws]
+        tree = mdvl.parse(md, indent=1)
+        fe = mdvl.extract_fences
+        mdvl.extract_fences = None # layout must not parse again
+        try:
+            assert [mdvl.layout(tree, **kw) for kw in kws] == exp
+        finally:
+            mdvl.extract_fences = fe
+        tree = mdvl.parse('one line')
+        assert mdvl.layout(tree) == mdvl.main('one line', no_print=True)[0]
+
+    def test_html(s):
+        md = dedent('''
+                    # Head *it*
+                    text with `a<b` and **emph**
+
+                    - item 1
+                    - item 2
+
+                    > quote
+                    >> deeper
+
+                    ```py
+                    x = 1 & 2
+                    ```
+                    ---''')
+        h = mdvl.render_html(md, header_numbering=-1)
+        assert h == '\n'.join([
+            '<h1>Head <em>it</em></h1>',
+            '<p>text with <code>a&lt;b</code> and <strong>emph</strong></p>',
+            '<ul>', '<li>item 1</li>', '<li>item 2</li>', '</ul>',
+            '<blockquote>', '<p>quote</p>', '<blockquote>', '<p>deeper</p>',
+            '</blockquote>', '</blockquote>',
+            '<pre><code class="language-py">x = 1 &amp; 2</code></pre>',
+            '<hr/>'])
+        h = mdvl.render_html('```x" onmouseover="alert(1)\nx\n```\n')
+        assert h == '<pre><code class="language-x">x</code></pre>'
+
+    def test_cache(s):
+        md = '# H1\n' + 'some *text* ' * 20
+        exp = [mdvl.main(md, no_print=True, term_width=w)[0] for w in (40, 60)]
+        mdvl.lru = None # created when first used
+        for i in range(3):
+            for k in range(3): # other docs, evicting
+                mdvl.main(md + str(k), no_print=True, cache_size=2)
+            # a width change must not hit the cached rendering:
+            for w, res in zip((40, 60), exp):
+                assert mdvl.main(md, no_print=True, cache_size=2,
+                                 term_width=w)[0] == res
+            assert len(mdvl.lru) == 2
+
+    def test_disk_cache(s):
+        with cache_home() as d:
+            fn = d + '/doc.md'
+            for md in '# H1\nfoo *it*', '# H1\nfoo *it* bar', 'single line':
+                with open(fn, 'w') as fd:
+                    fd.write(md)
+                exp = mdvl.main(md, no_print=True)[0]
+                for i in range(2): # miss, hit
+                    assert mdvl.render_file(fn) == exp
+                c = mdvl.cache_dir()
+            assert len(os.listdir(c)) == 3
+            mdvl.render_file(fn, term_width=40, disk_cache_bytes=1)
+            assert len(os.listdir(c)) == 0
+            # concurrent misses, each writes its own tmp file:
+            import threading
+            res = []
+            ts = [threading.Thread(target=lambda: res.append(
+                    mdvl.render_file(fn, term_width=30))) for i in range(8)]
+            [t.start() for t in ts]
+            [t.join() for t in ts]
+            assert res == [mdvl.main('single line', no_print=True)[0]] * 8
+            assert len(os.listdir(c)) == 1
+
+    def test_format_file(s):
+        import io
+        with cache_home() as d:
+            script = '\n'.join([
+                '#!/bin/bash', 'md_doc () {', '    echo x >> %s/runs' % d,
+                "    echo '# Tool\n\n<auto_command_doc>'", '}', '',
+                ": 'does foo'", 'function foo {', "    : 'param *x*'",
+                '    echo %s', '}', '', ": 'does bar'", 'function bar {',
+                '    echo bar', '}', 'test "$1" == make_doc && md_doc', ''])
+            fn = d + '/tool.sh'
+            def help(*args):
+                out = io.StringIO()
+                with contextlib.redirect_stdout(out):
+                    mdvl.format_file(*args)
+                return out.getvalue()
+            def runs():
+                with open(d + '/runs') as fd:
+                    return len(fd.read().split())
+            for v in 'foo', 'foo2':
+                with open(fn, 'w') as fd:
+                    fd.write(script % v)
+                os.chmod(fn, 0o755)
+                lines = (script % v).splitlines()
+                for args in ('-h',), ('fo',):
+                    for dev in 'false', 'true':
+                        exp = mdvl.bash_help(dev, '50', lines, fn, *args)
+                        for i in range(2): # miss, hit
+                            res = help(dev, '50', fn, *args)
+                            assert res == exp + '\n'
+                assert 'does foo param' in exp and not 'bar' in exp
+                assert ('echo %s' % v) in exp # dev help: code
+                assert 'Commands' in help('false', '50', fn, '-h')
+            assert runs() == 8 # make_doc: by bash_help and by the misses
+            assert help('false', '30', fn, '-h') != help('false', '50', fn,
+                                                         '-h')
+            assert runs() == 9
+
+    def test_format_python(s):
+        import io
+        with cache_home() as d:
+            fn = d + '/tool.py'
+            with open(fn, 'w') as fd:
+                fd.write(dedent('''
+                """
+                # Tool
+
+                Does *things*, it's 'quoted'
+                """
+                import not_installed_module # not imported by mdvl
+                def run(x):
+                    """runs x, see 'run'"""
+                    return x
+                def _private():
+                    "internal"
+                class Job(object):
+                    """A job"""
+                    def start(self):
+                        "starts it"
+                    def undocumented(self):
+                        pass
+                '''))
+            def help(*args):
+                out = io.StringIO()
+                with contextlib.redirect_stdout(out):
+                    mdvl.format_file(*args)
+                return out.getvalue()
+            out = help('false', '60', fn, '-h')
+            for t in ("it's 'quoted'", "runs x, see 'run'", 'A job',
+                      'Job.start', 'starts it', 'Commands'):
+                assert t in out, t
+            assert not 'internal' in out and not 'undocumented' in out
+            assert help('false', '60', fn, '-h') == out # cached
+            out = help('true', '60', fn, 'start')
+            assert 'Job.start' in out and 'def start(self):' in out
+            assert not 'run' in out
+            assert '_private' in help('true', '60', fn, '-h')
+
+    def test_func_index(s):
+        with cache_home() as d:
+            script = '#!/bin/bash\n%s\n: \'does %s\'\nfunction %s {\n' \
+                     '    : \'param *x*\'\n    echo\n}\n'
+            src, read = d + '/src', []
+            sf = mdvl.script_funcs
+            mdvl.script_funcs = lambda fn: read.append(fn) or sf(fn)
+            def write(fn, *a):
+                with open(src + '/' + fn, 'w') as fd:
+                    fd.write(script % a)
+            try:
+                os.makedirs(src + '/sub')
+                write('a.sh', '', 'backup of files', 'backup')
+                write('sub/b.sh', '# pad\n' * 3, 'restores a backup',
+                      'restore')
+                with open(src + '/README.md', 'w') as fd:
+                    fd.write('# function foo {')
+                idx = mdvl.func_index(src)
+                assert len(idx) == 3 and len(read) == 3
+                assert idx[src + '/sub/b.sh'][2] == [['restore', 6, [
+                    ": 'does restores a backup'"], [": 'param *x*'"],
+                    ' a backup does param restore restores x ']]
+                assert mdvl.func_index(src) == idx and len(read) == 3
+                write('a.sh', '', 'backup of files', 'backup_all')
+                os.unlink(src + '/README.md')
+                idx = mdvl.func_index(src)
+                assert len(idx) == 2 and read[3:] == [src + '/a.sh']
+                names = lambda *a: [f[1] for f in mdvl.find_funcs(idx, *a)]
+                assert names('back') == ['backup_all']
+                assert names('backup', True) == ['backup_all', 'restore']
+                assert names('Backup FILES', True) == ['backup_all']
+                assert names('files', False) == []
+                out = mdvl.func_help(src, 'store', term_width=40)
+                assert 'sub/b.sh' in out and 'line 7' in out
+                assert 'restores a backup param' in out and not 'a.sh' in out
+                assert mdvl.func_help(src, 'nothing') is None
+            finally:
+                mdvl.script_funcs = sf
+
+    def test_sections(s):
+        import subprocess
+        with cache_home() as d:
+            fn = d + '/doc.md'
+            md = dedent('''
+            # Handbook
+            intro
+            ## Install
+            ```
+            # no header
+            ```
+            text *here*
+            ### Deb
+            apt
+            ## Usage
+            use it
+            # Appendix
+            x''')
+            with open(fn, 'w') as fd:
+                fd.write(md)
+            kw = {'header_numbering': 5, 'no_print': True}
+            idx = mdvl.section_index(fn, **kw)
+            assert idx['numbered']
+            assert mdvl.section_index(fn, **kw) == idx # from the sidecar
+            assert [h[:4] for h in idx['heads']] == [
+                    (1, '1', 'Handbook', '1 Handbook'),
+                    (2, '1.1', 'Install', '1.1 Install'),
+                    (3, '1.1.1', 'Deb', '1.1.1 Deb'),
+                    (2, '1.2', 'Usage', '1.2 Usage'),
+                    (1, '2', 'Appendix', '2 Appendix')]
+            h = idx['heads'][1]
+            assert md.encode('utf-8')[h[4]:h[5]].startswith(b'## Install')
+            assert md.encode('utf-8')[h[4]:h[5]].endswith(b'apt\n')
+            # a section is rendered as it is in the whole document:
+            full = mdvl.main(md, **kw)[0]
+            for sect in '1.1', 'deb', 'Usage':
+                out = mdvl.render_section(fn, sect, **kw)
+                assert mdvl.strip_it(out, '\x1b[0m') in full
+            out = mdvl.render_section(fn, '1.1', **kw)
+            assert 'apt' in out and 'use it' not in out
+            assert mdvl.render_section(fn, '7', **kw) is None
+            # the sidecar, invalid when the file changes:
+            c = mdvl.cache_dir()
+            assert [f for f in os.listdir(c) if f.endswith('.idx')]
+            with open(fn, 'a') as fd:
+                fd.write('\n## More')
+            assert mdvl.section_index(fn, **kw)['heads'][-1][1] == '2.1'
+            out = subprocess.check_output([sys.executable, pth + '/mdvl.py',
+                                           fn, '--toc'], env=dict(
+                                               os.environ, term_width='40'))
+            assert b'    \x1b[1;38;5;72m1.1.1 Deb\x1b[0m\n' in out
+
+    def test_render_files(s):
+        import io
+        d = tempfile.mkdtemp()
+        try:
+            src, docs = d + '/src', {'a.md': '# A\nfoo *it*', 'x/b.md': '- b',
+                                     'x/y/c.md': 'c ' * 100, 'x/no.txt': 'x'}
+            os.makedirs(src + '/x/y')
+            for fn, md in docs.items():
+                with open(src + '/' + fn, 'w') as fd:
+                    fd.write(md)
+            for workers, files in (2, 3), (1, 0):
+                r = mdvl.render_files(src, d + '/out', workers, term_width=50)
+                assert (r['files'], r['skipped'], r['errors']) == (
+                        files, 3 - files, 0)
+            for fn, md in docs.items():
+                if fn.endswith('.md'):
+                    with open(d + '/out/' + fn[:-3] + '.ansi') as fd:
+                        exp = mdvl.main(md, no_print=True, term_width=50)[0]
+                        assert fd.read() == exp
+            os.utime(src + '/a.md', (time.time() + 10,) * 2)
+            assert mdvl.render_files(src, d + '/out', 1)['files'] == 1
+            # broken files are reported (not their text), the others rendered:
+            with open(src + '/x/bad.md', 'wb') as fd:
+                fd.write(b'\xff\xfe\x00')
+            with open(src + '/x/err.md', 'w') as fd:
+                fd.write('*abc def\nmore text') # fails to render
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                r = mdvl.render_files(src, d + '/out', 1)
+            assert (r['files'], r['errors']) == (1, 2)
+            out = out.getvalue().splitlines()
+            assert len(out) == 2 and 'bad.md' in out[0] and 'err.md' in out[1]
+            r = mdvl.render_files(src, d + '/out', 2) # in the pool, too
+            assert (r['files'], r['errors']) == (1, 2)
+        finally:
+            shutil.rmtree(d)
+
+    def test_daemon(s):
+        import subprocess, tempfile, shutil, signal
+        d = tempfile.mkdtemp()
+        env = dict(os.environ, mdvl_socket=d + '/s', XDG_CACHE_HOME=d)
+        srv = subprocess.Popen([sys.executable, pth + '/mdvl.py', '--serve'],
+                               stdout=subprocess.PIPE, env=env)
+        def run(*args, **kw):
+            inp = kw.pop('stdin', None) # else stdin is no pipe
+            i = subprocess.DEVNULL if inp is None else subprocess.PIPE
+            p = subprocess.Popen([sys.executable] + list(args), stdin=i,
+                                 stdout=subprocess.PIPE, env=dict(env, **kw))
+            return p.communicate(inp and inp.encode('utf-8'))[0]
+        try:
+            assert b'serving' in srv.stdout.readline()
+            md = '# H1\nfoo *it*\n- list ' + 'to wrap ' * 20
+            client = 'import mdvl; print(mdvl.client([%r], 40, False))'
+            assert run('-c', client % md, PYTHONPATH=pth).endswith(b'True\n')
+            # colors defaults from the client's environ, too:
+            for args, kw in (((md,), {}), ((md,), {'term_width': '30'}),
+                             ((md,), {'I': '1'}),
+                             ((), {'stdin': md + '\n'}), (('-h',), {})):
+                args = (pth + '/mdvl.py',) + args
+                exp = run(*args, mdvl_socket=d + '/none', **dict(kw))
+                assert b'H1' in exp or b'Config' in exp
+                assert run(*args, **kw) == exp
+            # a slow pipe client does not block the others:
+            slow = subprocess.Popen([sys.executable, pth + '/mdvl.py'],
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE, env=env)
+            p = subprocess.Popen([sys.executable, '-c', client % md],
+                                 stdout=subprocess.PIPE,
+                                 env=dict(env, PYTHONPATH=pth))
+            assert p.communicate(timeout=10)[0].endswith(b'True\n')
+            assert b'slow' in slow.communicate(b'# slow\n')[0]
+            # no zombies of the served clients:
+            chld = '/proc/%s/task/%s/children' % (srv.pid, srv.pid)
+            if os.path.exists(chld):
+                time.sleep(0.2)
+                assert open(chld).read().strip() == ''
+            # a stopped daemon: rendering in process, after the timeout:
+            srv.send_signal(signal.SIGSTOP)
+            try:
+                t0 = time.time()
+                assert run('-c', client % md, PYTHONPATH=pth).endswith(
+                        b'False\n')
+                assert time.time() - t0 < 5
+            finally:
+                srv.send_signal(signal.SIGCONT)
+            # only what the rendering reads is sent:
+            e = dict(os.environ)
+            os.environ.update({'SECRET': 'x', 'term_width': '30'})
+            try:
+                ce = mdvl.client_env()
+            finally:
+                os.environ.clear()
+                os.environ.update(e)
+            assert ce['term_width'] == '30' and 'SECRET' not in ce
+            # no connect to a socket in a dir others can write to:
+            os.chmod(d, 0o777)
+            assert run('-c', client % md, PYTHONPATH=pth).endswith(b'False\n')
+            os.chmod(d, 0o700)
+        finally:
+            srv.terminate()
+            srv.wait()
+            assert not os.path.exists(d + '/s')
+            shutil.rmtree(d)
+
+    def test_repaint(s):
+        old = mdvl.screen_lines(mdvl.main('# H\nfoo *it*\nbar', no_print=True,
+                                          term_width=20)[0])
+        new = list(old)
+        new[3] = 'changed'
+        r = mdvl.repaint(old, new)
+        assert r == '\x1b[4;1H\x1b[0mchanged\x1b[0m\x1b[K'
+        assert mdvl.repaint(new, new) == ''
+        assert mdvl.repaint(new, new[:2]).count('H') == len(new) - 2
+        # colors spanning lines are repeated:
+        assert mdvl.screen_lines('\x1b[1ma\nb\x1b[0m\nc') == [
+                '\x1b[1ma', '\x1b[1mb\x1b[0m', 'c']
+
+    def test_file_changes(s):
+        import tempfile, shutil
+        d = tempfile.mkdtemp()
+        try:
+            fn = d + '/f.md'
+            with open(fn, 'w') as fd:
+                fd.write('a')
+            wake = os.pipe()
+            ch = mdvl.file_changes(fn, 0.01, wake[0])
+            assert next(ch) is True
+            os.write(wake[1], b'x') # e.g. at a signal
+            assert next(ch) is False
+            with open(fn + '.tmp', 'w') as fd:
+                fd.write('bb')
+            os.rename(fn + '.tmp', fn) # as editors save
+            t0 = time.time()
+            assert next(ch) is True
+            assert time.time() - t0 < 1 # inotify, not waiting for timeout
+        finally:
+            [os.close(fd) for fd in wake]
+            shutil.rmtree(d)
+
+    def test_watch(s):
+        import subprocess, tempfile, shutil, select, signal
+        d = tempfile.mkdtemp()
+        fn = d + '/f.md'
+        def write(md): # as editors do, else the truncated file may be seen
+            with open(fn + '.tmp', 'w') as fd:
+                fd.write(md)
+            os.rename(fn + '.tmp', fn)
+        def read_until(marker, got=b''):
+            t0 = time.time()
+            while marker not in got and time.time() - t0 < 5:
+                if select.select([p.stdout], [], [], 0.1)[0]:
+                    got += os.read(p.stdout.fileno(), 65536)
+            return got
+        md = '# H1\n\nfoo *it*\n\n' + 'line\n' * 30
+        write(md)
+        env = dict(os.environ, term_width='40', LINES='10')
+        p = subprocess.Popen([sys.executable, pth + '/mdvl.py', '--watch', fn],
+                             stdout=subprocess.PIPE, env=env)
+        try:
+            first = read_until(b'\x1b[10;1H')
+            assert first.startswith(b'\x1b[?1049h') and b'\x1b[2J' in first
+            assert b'\x1b[11;1H' not in first # only what fits
+            write(md.replace('foo', 'bar'))
+            upd = read_until(b'\x1b[K')
+            assert upd == b'\x1b[5;1H\x1b[0mbar \x1b[1;38;5;72mit' \
+                          b'\x1b[0m\x1b[0m\x1b[K'
+            p.send_signal(signal.SIGWINCH) # full repaint at new size
+            assert b'\x1b[2J' in read_until(b'\x1b[10;1H')
+            p.send_signal(signal.SIGINT)
+            assert p.stdout.read().endswith(b'\x1b[?1049l')
+        finally:
+            p.kill()
+            p.wait()
+            shutil.rmtree(d)
+
+    def test_pager(s):
+        md = '\n\n'.join(['# H%s\n\ntext *%s*\n\n> quote\n\n## Sub %s' % (
+                           i, 'it ' * i, i) for i in range(1, 40)])
+        kw = {'header_numbering': 5, 'term_width': 40, 'indent': 2}
+        exp = mdvl.main(md, no_print=True, **kw)[0].split('\n')[1:-1]
+        p = mdvl.Pager(md, prefetch=1, **kw)
+        assert len(p.view((0, 0), 5)) == 5
+        assert len(p.out) < 5 # lazy
+        # jumping ahead: rendering only there, numbers as in main:
+        pos = p.find_header('H30')
+        # (at the empty line before the segment):
+        assert p.view(pos, 2) == ['  '] + [l for l in exp if 'H30' in l]
+        assert p.view(p.find_header('Sub 30'), 2)[1:] == [
+                l for l in exp if '30.1 Sub 30' in l]
+        assert p.find_header('H30', pos) is None
+        assert p.src_line(pos) == md.splitlines().index('# H30')
+        assert p.find_line(p.src_line(pos) + 1) == pos
+        n = len(p.segment(pos[0]))
+        assert p.move(pos, n + 1) == (pos[0] + 1, 1)
+        assert p.move(p.move(pos, 7), -7) == pos
+        assert p.move((0, 0), -3) == (0, 0)
+        assert p.view(p.end(3), 10) == exp[-3:]
+        # all of it:
+        assert [l for i in range(len(p.index)) for l in p.segment(i)] == exp
+        assert mdvl.Pager('').view((0, 0), 3) == []
+
+    def test_page(s):
+        import subprocess, pty, fcntl, termios, struct, select, tempfile
+        fn = tempfile.mktemp()
+        with open(fn, 'w') as fd:
+            fd.write('\n\n'.join(['# H%s\n\nline %s' % (i, i)
+                                   for i in range(100)]))
+        m, sl = pty.openpty()
+        fcntl.ioctl(sl, termios.TIOCSWINSZ, struct.pack('hhhh', 6, 40, 0, 0))
+        p = subprocess.Popen([sys.executable, pth + '/mdvl.py', '--page', fn],
+                             stdin=sl, stdout=sl)
+        def send(k, marker):
+            os.write(m, k)
+            got, t0 = b'', time.time()
+            while marker not in got and time.time() - t0 < 5:
+                if select.select([m], [], [], 0.1)[0]:
+                    got += os.read(m, 65536)
+            assert marker in got, (k, marker, got)
+        try:
+            send(b'', b'%s 1/399 ' % fn.encode('utf-8'))
+            send(b'G', b'line 99')
+            send(b'g', b'1/399')
+            send(b'/H5\r', b' 21/399 ')
+            send(b'n', b' 201/399 ') # H50
+            send(b'/nix\r', b'not found')
+            send(b':301\r', b' 301/399 ')
+            send(b'\x1b[A', b' 299/399 ') # up, into the previous segment
+            send(b'q', b'\x1b[?1049l')
+            assert p.wait(5) == 0
+        finally:
+            p.poll() is None and p.kill()
+            os.close(m), os.close(sl), os.unlink(fn)
 
 
 class M(unittest.TestCase):
@@ -141,6 +893,60 @@ class M(unittest.TestCase):
         '''
         , 'test_width', indent=10, width=10, rindent=2)
 
+    def test_blocks(s):
+        s.c('''
+        # H1
+        para line one
+          continued *here*
+        > quoted
+        continued lazily
+        >> deeper
+        >> - list in quote
+        - item one
+          wraps **on**
+        -a: option A
+        -bb: option B which is long enough to be wrapped by the renderer for sure
+        *key* value
+
+            indented code
+            more code
+        after code
+        ''', 'test_blocks', term_width=40)
+
+    def test_many_code_blocks(s):
+        # placeholder 1 must not match the start of placeholder 10:
+        md = '\n\n'.join(['```sh\necho %s\n```' % i if i % 2 else
+                           '    code %s' % i for i in range(12)])
+        s.c(md, 'test_many_code_blocks')
+
+    def test_fences(s):
+        s.c('''
+        # H1
+        ~~~
+        tilde fenced
+        ~~~
+        ````md
+        ```
+        backticks inside
+        ```
+        ````
+
+        ```code``` inline, not a fence
+        ```python
+        unclosed, until the end
+        ''', 'test_fences')
+
+    def test_inline(s):
+        s.c('''
+        a `code with *stars*` and **em** and *it*
+
+        a solitary * star, an unclosed `backtick
+
+        an unclosed **emph in this block
+
+        this is *not* affected
+        ''', 'test_inline')
+
     def test_single_line_mode(s):
         s.c('> this is single line, no indent, no line sep'
             , 'test_single_line_mode')